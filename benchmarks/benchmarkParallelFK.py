@@ -0,0 +1,42 @@
+import argparse
+import os
+import time
+import numpy as np
+from bvhTools.bvhIO import readBvh
+from bvhTools.bvhDataTypes import BVHData, MotionData
+
+def buildLongClip(bvhPath, numFrames):
+    # Tiles the frames of a real take until the requested length is reached
+    bvhData = readBvh(bvhPath, dtype=np.float64)
+    frames = bvhData.motion.getFramesArray()
+    repeats = -(-numFrames // len(frames))
+    longFrames = np.tile(frames, (repeats, 1))[:numFrames]
+    return BVHData(bvhData.skeleton, MotionData(numFrames, bvhData.motion.frameTime, longFrames), bvhData.header)
+
+def timeFK(bvhData, repeats, **fkOptions):
+    bestTime = float("inf")
+    for _ in range(repeats):
+        startTime = time.perf_counter()
+        bvhData.getFKAllFrames(**fkOptions)
+        bestTime = min(bestTime, time.perf_counter() - startTime)
+    return bestTime
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of the chunked / parallel FK for a long clip")
+    parser.add_argument("--bvh", default=os.path.join(os.path.dirname(__file__), "..", "testBvhFiles", "test2.bvh"))
+    parser.add_argument("--frames", type=int, default=120 * 60 * 10)
+    parser.add_argument("--chunkSize", type=int, default=None)
+    parser.add_argument("--maxWorkers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    bvhData = buildLongClip(args.bvh, args.frames)
+    print(f"{args.frames} frames, {len(bvhData.skeleton.joints)} joints, {os.cpu_count()} CPUs available")
+    baseTime = timeFK(bvhData, args.repeats)
+    print(f"{'serial':>8} {'-':>8} {baseTime:8.3f}s {args.frames / baseTime:12.0f} frames/s   x1.00")
+
+    workerCounts = sorted(set([1, 2, 4, 8, args.maxWorkers]))
+    for executor in ["thread", "process"]:
+        for workers in [w for w in workerCounts if w <= args.maxWorkers]:
+            elapsed = timeFK(bvhData, args.repeats, workers=workers, chunkSize=args.chunkSize, executor=executor)
+            print(f"{executor:>8} {workers:>8} {elapsed:8.3f}s {args.frames / elapsed:12.0f} frames/s   x{baseTime / elapsed:.2f}")
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from bvhTools.bvhIO import readBvh, writeBvh, writeBvhToCsv, writePositionsToCsv, buildBvhStructure
+from bvhTools import bvhManipulation, bvhSlicer
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testBvhFiles")
+
+# Synthetic clips (joints, frames) for each scale, added to the two test files
+SCALES = {
+    "small": [(20, 10000)],
+    "medium": [(20, 100000), (100, 100000), (300, 20000)],
+    "large": [(20, 1000000), (100, 300000), (300, 100000)],
+}
+
+# Per-frame loops are skipped above this length, they would take hours on the large clips
+MAX_PER_FRAME_LOOP = 20000
+
+def buildSyntheticHeader(numJoints, seed=0):
+    # A humanoid base (so the feet exist for centerSkeletonFeet) plus extra joints hanging from random joints
+    random = np.random.default_rng(seed)
+    joints = [("Hips", None), ("LeftUpLeg", 0), ("LeftLeg", 1), ("LeftFoot", 2), ("RightUpLeg", 0), ("RightLeg", 4), ("RightFoot", 5), ("Spine", 0)]
+    while(len(joints) < numJoints):
+        joints.append((f"Joint{len(joints)}", int(random.integers(0, len(joints)))))
+    children = [[] for _ in joints]
+    for jointIndex, (_, parentIndex) in enumerate(joints):
+        if(parentIndex is not None):
+            children[parentIndex].append(jointIndex)
+
+    header = ["HIERARCHY"]
+    pendingLines = [(0, 0, "open")]
+    while(len(pendingLines) > 0):
+        jointIndex, depth, action = pendingLines.pop()
+        indent = "\t" * depth
+        if(action == "close"):
+            header.append(indent + "}")
+            continue
+        jointName = joints[jointIndex][0]
+        offset = random.uniform(-10, 10, 3)
+        header.append(indent + ("ROOT " if jointIndex == 0 else "JOINT ") + jointName)
+        header.append(indent + "{")
+        header.append(indent + "\tOFFSET " + " ".join(f"{value:.6f}" for value in offset))
+        if(jointIndex == 0):
+            header.append(indent + "\tCHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation")
+        else:
+            header.append(indent + "\tCHANNELS 3 Zrotation Xrotation Yrotation")
+        if(len(children[jointIndex]) == 0):
+            header += [indent + "\tEnd Site", indent + "\t{", indent + "\t\tOFFSET 0.000000 5.000000 0.000000", indent + "\t}"]
+        pendingLines.append((jointIndex, depth, "close"))
+        for childIndex in reversed(children[jointIndex]):
+            pendingLines.append((childIndex, depth + 1, "open"))
+    return header, numJoints * 3 + 3
+
+def buildSyntheticClip(numJoints, numFrames, seed=0):
+    header, numChannels = buildSyntheticHeader(numJoints, seed)
+    # Smooth sine motion, so the data looks like (and compresses like) a real take
+    random = np.random.default_rng(seed)
+    times = np.arange(numFrames)[:, None] / 120.0
+    motion = 30.0 * np.sin(2 * np.pi * random.uniform(0.1, 2.0, numChannels) * times + random.uniform(0, np.pi, numChannels))
+    motion[:, 0:3] = times * random.uniform(-50, 50, 3)
+    return buildBvhStructure(header, motion, numFrames, 1.0 / 120.0, dtype=np.float64)
+
+def findJoint(bvhData, candidates):
+    for jointName in candidates:
+        if(jointName in bvhData.skeleton.joints):
+            return jointName
+    return None
+
+def getCases(bvhPath, workDir):
+    bvhData = readBvh(bvhPath, dtype=np.float64)
+    numFrames = bvhData.motion.numFrames
+    leftFoot = findJoint(bvhData, ["LeftFoot", "foot.L"])
+    rightFoot = findJoint(bvhData, ["RightFoot", "foot.R"])
+    restJoint = findJoint(bvhData, ["LeftUpLeg", "thigh.L"])
+    windowStarts = list(np.linspace(0, max(numFrames - 100, 0), 100, dtype=int))
+    windowEnds = [start + min(100, numFrames) for start in windowStarts]
+    outputPath = os.path.join(workDir, "output")
+
+    # (name, setup, run): setup is not timed, its result is passed to run
+    cases = [
+        ("readBvh", None, lambda _: readBvh(bvhPath)),
+        ("readBvh float64", None, lambda _: readBvh(bvhPath, dtype=np.float64)),
+        ("writeBvh", None, lambda _: writeBvh(bvhData, outputPath + ".bvh")),
+        ("writeBvhToCsv", None, lambda _: writeBvhToCsv(bvhData, outputPath + ".csv")),
+        ("writePositionsToCsv", None, lambda _: writePositionsToCsv(bvhData, outputPath + "_positions.csv")),
+        ("getFKAllFrames", None, lambda _: bvhData.getFKAllFrames()),
+        ("centerSkeletonRoot", None, lambda _: bvhManipulation.centerSkeletonRoot(bvhData)),
+        ("centerSkeletonXZ", None, lambda _: bvhManipulation.centerSkeletonXZ(bvhData)),
+        ("centerSkeletonAroundJoint", None, lambda _: bvhManipulation.centerSkeletonAroundJoint(bvhData, restJoint)),
+        ("rotateSkeletonLocal", None, lambda _: bvhManipulation.rotateSkeletonLocal(bvhData, [0, 45, 0])),
+        ("rotateSkeletonWorld", None, lambda _: bvhManipulation.rotateSkeletonWorld(bvhData, [0, 45, 0])),
+        ("moveSkeleton", None, lambda _: bvhManipulation.moveSkeleton(bvhData, [10, 0, -10])),
+        ("setRestPose", lambda: bvhData.copy(), lambda bvhCopy: bvhCopy.setRestPose({restJoint: [0, 0, 30]})),
+        ("getBvhSlices x100", None, lambda _: bvhSlicer.getBvhSlices(bvhData, windowStarts, windowEnds)),
+        ("groupBvhSlices x100", lambda: bvhSlicer.getBvhSlices(bvhData, windowStarts, windowEnds), lambda slices: bvhSlicer.groupBvhSlices(slices)),
+        ("appendBvhSlices x100", lambda: bvhSlicer.getBvhSlices(bvhData, windowStarts, windowEnds), lambda slices: bvhSlicer.appendBvhSlices(bvhData, slices)),
+    ]
+    if(leftFoot is not None and rightFoot is not None):
+        cases.append(("centerSkeletonFeet", None, lambda _: bvhManipulation.centerSkeletonFeet(bvhData, leftFoot, rightFoot)))
+    if(numFrames <= MAX_PER_FRAME_LOOP):
+        cases.append(("getFKAtFrame all frames", None, lambda _: [bvhData.getFKAtFrame(frame) for frame in range(numFrames)]))
+    return cases
+
+def runCase(setup, run, repeats):
+    times = []
+    for _ in range(repeats):
+        argument = setup() if setup is not None else None
+        startTime = time.perf_counter()
+        run(argument)
+        times.append(time.perf_counter() - startTime)
+    # The peak memory is measured in a separate run, tracemalloc slows the code down
+    argument = setup() if setup is not None else None
+    tracemalloc.start()
+    run(argument)
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"time": min(times), "medianTime": float(np.median(times)), "peakMemory": peakMemory}
+
+def runSuite(scale, repeats, selectedCases=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as workDir:
+        clips = [(fileName, os.path.join(TEST_FILES_DIR, fileName)) for fileName in ["test2.bvh", "test3.bvh"]]
+        for numJoints, numFrames in SCALES[scale]:
+            clipName = f"synthetic_{numJoints}j_{numFrames}f.bvh"
+            clipPath = os.path.join(workDir, clipName)
+            writeBvh(buildSyntheticClip(numJoints, numFrames), clipPath)
+            clips.append((clipName, clipPath))
+
+        for clipName, clipPath in clips:
+            results[clipName] = {}
+            for caseName, setup, run in getCases(clipPath, workDir):
+                if(selectedCases is not None and caseName not in selectedCases):
+                    continue
+                results[clipName][caseName] = runCase(setup, run, repeats)
+                result = results[clipName][caseName]
+                print(f"{clipName:<32} {caseName:<28} {result['time'] * 1000:10.2f} ms {result['peakMemory'] / 2**20:10.2f} MiB", flush=True)
+    return results
+
+def compareResults(results, baseline, tolerance):
+    # Returns the cases that are slower (or use more memory) than the baseline by more than the tolerance
+    regressions = []
+    for clipName, cases in results.items():
+        for caseName, result in cases.items():
+            baseResult = baseline.get("results", {}).get(clipName, {}).get(caseName)
+            if(baseResult is None):
+                continue
+            for metric in ["time", "peakMemory"]:
+                if(baseResult[metric] > 0 and result[metric] > baseResult[metric] * (1 + tolerance)):
+                    regressions.append((clipName, caseName, metric, baseResult[metric], result[metric]))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and peak memory of the IO, FK, manipulation and slicing functions")
+    parser.add_argument("--scale", choices=list(SCALES.keys()), default="small")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cases", nargs="*", default=None, help="Only run these cases")
+    parser.add_argument("--save", default=None, help="Store the results as a JSON baseline")
+    parser.add_argument("--compare", default=None, help="Compare with a JSON baseline, and exit with an error on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown / memory growth when comparing")
+    args = parser.parse_args()
+
+    results = runSuite(args.scale, args.repeats, args.cases)
+    report = {
+        "scale": args.scale,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if(args.save is not None):
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if(args.compare is not None):
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline, args.tolerance)
+        for clipName, caseName, metric, baseValue, value in regressions:
+            print(f"REGRESSION: {clipName} {caseName} {metric}: {baseValue:.6g} -> {value:.6g} (x{value / baseValue:.2f})")
+        if(len(regressions) > 0):
+            sys.exit(1)
+        print("No regressions")
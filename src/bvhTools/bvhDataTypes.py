@@ -1,18 +1,138 @@
 from scipy.spatial.transform import Rotation as R
 import numpy as np
+from bvhTools.bvhProfiler import profiled, argumentFrames
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import concurrent.futures
 import copy
+import os
 import re
 
+def getAxisRotationMatrices(axis, angles):
+    cos, sin = np.cos(angles), np.sin(angles)
+    ones, zeros = np.ones_like(angles), np.zeros_like(angles)
+    if(axis == "X"):
+        elements = [ones, zeros, zeros, zeros, cos, -sin, zeros, sin, cos]
+    elif(axis == "Y"):
+        elements = [cos, zeros, sin, zeros, ones, zeros, -sin, zeros, cos]
+    else:
+        elements = [cos, -sin, zeros, sin, cos, zeros, zeros, zeros, ones]
+    return np.stack(elements, axis=-1).reshape(angles.shape + (3, 3))
+
+def eulerToMatrices(rotOrder, angles, degrees=True):
+    # Batched equivalent of R.from_euler(rotOrder, angles).as_matrix() for intrinsic (uppercase) orders
+    angles = np.asarray(angles, dtype=np.float64)
+    if(degrees):
+        angles = np.radians(angles)
+    matrices = getAxisRotationMatrices(rotOrder[0], angles[..., 0])
+    for axisPosition in (1, 2):
+        matrices = np.matmul(matrices, getAxisRotationMatrices(rotOrder[axisPosition], angles[..., axisPosition]))
+    return matrices
+
+def multiplyQuaternions(q1, q2):
+    # Hamilton product of (..., 4) quaternions in scalar-last (x, y, z, w) order, the order used by scipy
+    x1, y1, z1, w1 = np.moveaxis(q1, -1, 0)
+    x2, y2, z2, w2 = np.moveaxis(q2, -1, 0)
+    return np.stack([w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+                     w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2], axis=-1)
+
+def eulerToQuaternions(rotOrder, angles, degrees=True):
+    # Batched equivalent of R.from_euler(rotOrder, angles).as_quat() for intrinsic (uppercase) orders.
+    # The product of the three axis quaternions is written out, since most of their components are zero.
+    angles = np.asarray(angles, dtype=np.float64)
+    if(degrees):
+        angles = np.radians(angles)
+    halfAngles = angles / 2
+    cosA, cosB, cosC = np.moveaxis(np.cos(halfAngles), -1, 0)
+    sinA, sinB, sinC = np.moveaxis(np.sin(halfAngles), -1, 0)
+    a, b, c = ["XYZ".index(axis) for axis in rotOrder]
+    sign = 1.0 if (b - a) % 3 == 1 else -1.0
+    firstA, firstB, firstC, firstW = sinA * cosB, cosA * sinB, sign * sinA * sinB, cosA * cosB
+    quaternions = np.empty(angles.shape[:-1] + (4,))
+    quaternions[..., a] = cosC * firstA + sign * sinC * firstB
+    quaternions[..., b] = cosC * firstB - sign * sinC * firstA
+    quaternions[..., c] = cosC * firstC + sinC * firstW
+    quaternions[..., 3] = cosC * firstW - sinC * firstC
+    return quaternions
+
+def quaternionsToMatrices(quaternions):
+    quaternions = quaternions / np.linalg.norm(quaternions, axis=-1, keepdims=True)
+    x, y, z, w = np.moveaxis(quaternions, -1, 0)
+    return np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w),
+                     2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w),
+                     2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1).reshape(quaternions.shape[:-1] + (3, 3))
+
+def eulerFromMatrixElements(rotOrder, getElement, degrees=True):
+    # Euler angles of matrices = Ri(a) Rj(b) Rk(c), from a function returning the (row, column) element of all the matrices
+    i, j, k = ["XYZ".index(axis) for axis in rotOrder]
+    sign = 1.0 if (j - i) % 3 == 1 else -1.0
+    middleSine = getElement(i, k)
+    middle = np.arcsin(np.clip(sign * middleSine, -1.0, 1.0))
+    first = np.arctan2(-sign * getElement(j, k), getElement(k, k))
+    last = np.arctan2(-sign * getElement(i, j), getElement(i, i))
+    # Gimbal lock: only first + last (or first - last) is defined, so the last angle is set to 0
+    locked = np.abs(middleSine) > 1 - 1e-9
+    if(np.any(locked)):
+        first[locked] = np.arctan2(sign * getElement(k, j)[locked], getElement(j, j)[locked])
+        last[locked] = 0.0
+    angles = np.stack([first, middle, last], axis=-1)
+    return np.degrees(angles) if degrees else angles
+
+def matricesToEuler(rotOrder, matrices, degrees=True):
+    # Batched equivalent of R.from_matrix(matrices).as_euler(rotOrder) for intrinsic (uppercase) orders
+    return eulerFromMatrixElements(rotOrder, lambda row, column: matrices[..., row, column], degrees)
+
+def quaternionsToEuler(rotOrder, quaternions, degrees=True):
+    # Only the matrix elements needed for the angles are computed, not the whole matrices
+    components = np.moveaxis(quaternions, -1, 0)
+    scale = 2.0 / np.sum(quaternions * quaternions, axis=-1)
+    def getElement(row, column):
+        if(row == column):
+            others = [axis for axis in range(3) if axis != row]
+            return 1 - scale * (components[others[0]] ** 2 + components[others[1]] ** 2)
+        other = 3 - row - column
+        sign = 1.0 if (column - row) % 3 == 1 else -1.0
+        return scale * (components[row] * components[column] - sign * components[other] * components[3])
+    return eulerFromMatrixElements(rotOrder, getElement, degrees)
+
+def getClosestEulerAngles(angles, referenceAngles):
+    # Every rotation has two sets of Euler angles, (a, b, c) and (a + 180, 180 - b, c + 180), each one also equivalent up to +-360 per angle.
+    # The set closest to the reference (e.g. the current channel values) is kept, so the channels stay continuous.
+    otherAngles = angles + np.array([180.0, 0.0, 180.0])
+    otherAngles[..., 1] = 180.0 - angles[..., 1]
+    candidates = []
+    for candidate in (angles, otherAngles):
+        candidate = candidate + 360.0 * np.round((referenceAngles - candidate) / 360.0)
+        candidates.append((candidate, np.sum(np.abs(candidate - referenceAngles), axis=-1)))
+    return np.where((candidates[1][1] < candidates[0][1])[..., None], candidates[1][0], candidates[0][0])
+
+def matricesToRotation6D(matrices):
+    # Continuous 6D representation: the first two columns of the rotation matrices
+    return np.concatenate([matrices[..., :, 0], matrices[..., :, 1]], axis=-1)
+
+def rotation6DToMatrices(rotations6D):
+    # Gram-Schmidt on the two columns, so any (e.g. predicted) 6D vector gives a valid rotation
+    firstColumns = rotations6D[..., 0:3] / np.linalg.norm(rotations6D[..., 0:3], axis=-1, keepdims=True)
+    secondColumns = rotations6D[..., 3:6] - np.sum(firstColumns * rotations6D[..., 3:6], axis=-1, keepdims=True) * firstColumns
+    secondColumns = secondColumns / np.linalg.norm(secondColumns, axis=-1, keepdims=True)
+    return np.stack([firstColumns, secondColumns, np.cross(firstColumns, secondColumns)], axis=-1)
+
 class Joint:
+    # Skeletons are kept for every loaded clip, so joints use slots and store their offset as a small array
+    __slots__ = ("name", "offset", "channels", "children", "parent")
+
     def __init__(self, name, offset, channels, parent=None):
         self.name = name
-        self.offset = offset 
+        self.offset = None
+        self.setOffset(offset)
         self.channels = channels
         self.children = []
         self.parent = parent
 
     def setOffset(self, offset):
-        self.offset = offset
+        self.offset = None if offset is None else np.array(offset, dtype=np.float64).reshape(-1)
 
     def setChannels(self, channels):
         self.channels = channels
@@ -83,24 +203,179 @@ class Joint:
             axis = axis / np.linalg.norm(axis)
             return R.from_rotvec(angle * axis)
 
+ROTATION_ORDERS = ["XYZ", "XZY", "YXZ", "YZX", "ZXY", "ZYX"]
+
+class SkeletonLayout:
+    # Flat, array-based description of a skeleton, built once so that per-frame code only does array indexing.
+    # Joints are in depth-first order (the order of skeleton.joints), so parents always come before their children.
+    def __init__(self, skeleton):
+        joints = list(skeleton.joints.values())
+        self.jointNames = [joint.name for joint in joints]
+        self.jointPositions = {jointName: jointPosition for jointPosition, jointName in enumerate(self.jointNames)}
+        self.numJoints = len(joints)
+        self.parents = np.array([-1 if joint.parent is None else self.jointPositions[joint.parent.name] for joint in joints], dtype=int)
+        self.offsets = np.array([joint.offset for joint in joints], dtype=np.float64).reshape(self.numJoints, 3)
+        self.channelStarts = np.array([skeleton.getJointIndex(joint.name) for joint in joints], dtype=int)
+        self.numChannels = sum(joint.getChannelCount() for joint in joints)
+
+        # Rotation columns are stored in the rotation order of each joint, position columns in X, Y, Z order. -1 = no channel.
+        self.rotationOrders = []
+        self.rotationOrderCodes = np.full(self.numJoints, -1, dtype=int)
+        self.rotationColumns = np.full((self.numJoints, 3), -1, dtype=int)
+        self.positionColumns = np.full((self.numJoints, 3), -1, dtype=int)
+        for jointPosition, joint in enumerate(joints):
+            jointIndex = self.channelStarts[jointPosition]
+            rotOrder = None
+            if("Xrotation" in joint.channels and "Yrotation" in joint.channels and "Zrotation" in joint.channels):
+                rotOrder = joint.getRotationChannelsOrder()
+                self.rotationOrderCodes[jointPosition] = ROTATION_ORDERS.index(rotOrder)
+                self.rotationColumns[jointPosition] = [jointIndex + joint.channels.index(axis + "rotation") for axis in rotOrder]
+            if("Xposition" in joint.channels and "Yposition" in joint.channels and "Zposition" in joint.channels):
+                self.positionColumns[jointPosition] = [jointIndex + joint.channels.index(axis + "position") for axis in "XYZ"]
+            self.rotationOrders.append(rotOrder)
+        self.hasRotation = self.rotationOrderCodes >= 0
+        self.hasPosition = self.positionColumns[:, 0] >= 0
+
+        # Joints grouped by rotation order, to convert each group with one batched call
+        self.rotationGroups = {}
+        for code in np.unique(self.rotationOrderCodes[self.hasRotation]):
+            groupJoints = np.flatnonzero(self.rotationOrderCodes == code)
+            self.rotationGroups[ROTATION_ORDERS[code]] = (groupJoints, self.rotationColumns[groupJoints])
+
+        # Joints grouped by depth, so that FK chains a whole level at once
+        self.depths = np.zeros(self.numJoints, dtype=int)
+        for jointPosition in range(1, self.numJoints):
+            self.depths[jointPosition] = self.depths[self.parents[jointPosition]] + 1
+        self.levels = [np.flatnonzero(self.depths == depth) for depth in range(1, self.depths.max(initial=0) + 1)]
+
+def computeLocalRotationMatrices(layout, frameArray, localRots):
+    localRots[:] = np.eye(3)
+    for rotOrder, (groupJoints, groupColumns) in layout.rotationGroups.items():
+        localRots[:, groupJoints] = eulerToMatrices(rotOrder, frameArray[:, groupColumns])
+    return localRots
+
+def computeFKInto(layout, frameArray, globalRots, globalPos):
+    # FK of a (numFrames, numChannels) block, written into preallocated (numFrames, numJoints, 3, 3) and (numFrames, numJoints, 3) buffers
+    computeLocalRotationMatrices(layout, frameArray, globalRots)
+    globalPos[:] = 0.0
+    if(layout.hasPosition[0]):
+        globalPos[:, 0] = frameArray[:, layout.positionColumns[0]]
+
+    # Every parent is resolved before its children, so chaining one depth level at a time turns the recursion into a few batched matmuls
+    for level in layout.levels:
+        parents = layout.parents[level]
+        parentRots = globalRots[:, parents]
+        globalRots[:, level] = np.matmul(parentRots, globalRots[:, level])
+        globalPos[:, level] = np.einsum("fjab,jb->fja", parentRots, layout.offsets[level]) + globalPos[:, parents]
+    return globalRots, globalPos
+
+def computeFKChunks(layout, frameArray, globalRots, globalPos, chunks):
+    for startFrame, endFrame in chunks:
+        computeFKInto(layout, frameArray[startFrame:endFrame], globalRots[startFrame:endFrame], globalPos[startFrame:endFrame])
+
+def attachSharedArray(sharedArraySpec):
+    sharedName, shape, dtype = sharedArraySpec
+    sharedBlock = shared_memory.SharedMemory(name=sharedName)
+    return sharedBlock, np.ndarray(shape, dtype=dtype, buffer=sharedBlock.buf)
+
+def computeFKChunkShared(layout, framesSpec, rotsSpec, posSpec, startFrame, endFrame):
+    # Runs in the worker processes. Inputs and outputs live in shared memory, so only the chunk bounds are sent around.
+    sharedBlocks = []
+    try:
+        arrays = []
+        for sharedArraySpec in (framesSpec, rotsSpec, posSpec):
+            sharedBlock, array = attachSharedArray(sharedArraySpec)
+            sharedBlocks.append(sharedBlock)
+            arrays.append(array)
+        frameArray, globalRots, globalPos = arrays
+        computeFKInto(layout, frameArray[startFrame:endFrame], globalRots[startFrame:endFrame], globalPos[startFrame:endFrame])
+        del frameArray, globalRots, globalPos, arrays
+    finally:
+        for sharedBlock in sharedBlocks:
+            sharedBlock.close()
+
+def releaseSharedBlock(sharedBlock):
+    sharedBlock.close()
+    sharedBlock.unlink()
+
+def computeFKParallel(layout, frameArray, workers=None, chunkSize=None, executor="thread"):
+    # Splits the frames into chunks that are evaluated by a pool of threads or processes, writing straight into the output buffers
+    numFrames = frameArray.shape[0]
+    workers = workers or os.cpu_count() or 1
+    if(chunkSize is None):
+        chunkSize = max(1024, -(-numFrames // (4 * workers)))
+    chunks = [(startFrame, min(startFrame + chunkSize, numFrames)) for startFrame in range(0, numFrames, chunkSize)]
+    if(workers == 1 or len(chunks) <= 1):
+        globalRots = np.empty((numFrames, layout.numJoints, 3, 3))
+        globalPos = np.empty((numFrames, layout.numJoints, 3))
+        computeFKChunks(layout, frameArray, globalRots, globalPos, chunks)
+        return globalRots, globalPos
+
+    if(executor == "thread"):
+        # NumPy releases the GIL inside the batched operations, so threads can share the output arrays directly
+        globalRots = np.empty((numFrames, layout.numJoints, 3, 3))
+        globalPos = np.empty((numFrames, layout.numJoints, 3))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda chunk: computeFKChunks(layout, frameArray, globalRots, globalPos, [chunk]), chunks))
+        return globalRots, globalPos
+    if(executor != "process"):
+        raise Exception(f"Unknown FK executor ({executor}). Use 'thread' or 'process'")
+
+    shapes = [frameArray.shape, (numFrames, layout.numJoints, 3, 3), (numFrames, layout.numJoints, 3)]
+    sharedBlocks = [shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8)) for shape in shapes]
+    try:
+        sharedFrames = np.ndarray(shapes[0], dtype=np.float64, buffer=sharedBlocks[0].buf)
+        sharedFrames[:] = frameArray
+        specs = [(sharedBlock.name, shape, np.float64) for sharedBlock, shape in zip(sharedBlocks, shapes)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(computeFKChunkShared, layout, specs[0], specs[1], specs[2], startFrame, endFrame) for startFrame, endFrame in chunks]
+            for future in futures:
+                future.result()
+        del sharedFrames
+        releaseSharedBlock(sharedBlocks.pop(0))
+        # Each output is copied out and its block released right away (the positions first, as they are smaller), so only one output
+        # is ever held twice, and the input is not held at all while copying
+        globalPos = np.array(np.ndarray(shapes[2], dtype=np.float64, buffer=sharedBlocks[1].buf))
+        releaseSharedBlock(sharedBlocks.pop(1))
+        globalRots = np.array(np.ndarray(shapes[1], dtype=np.float64, buffer=sharedBlocks[0].buf))
+        releaseSharedBlock(sharedBlocks.pop(0))
+    finally:
+        for sharedBlock in sharedBlocks:
+            releaseSharedBlock(sharedBlock)
+    return globalRots, globalPos
+
 class Skeleton:
     def __init__(self, rootJoint):
         self.root = rootJoint
         self.joints = self.buildJointDict(rootJoint)
         self.jointIndexes = self.buildJointIndexDict(rootJoint, [0])
+        self.layout = None
+
+    def getLayout(self):
+        if(self.layout is None):
+            self.layout = SkeletonLayout(self)
+        return self.layout
+
+    def resetLayout(self):
+        # Has to be called after changing the joint offsets or channels
+        self.layout = None
+
+    def iterJoints(self, joint):
+        # Depth-first preorder (the order of the channels in the motion), without recursion so deep chains are linear
+        pendingJoints = [joint]
+        while(len(pendingJoints) > 0):
+            joint = pendingJoints.pop()
+            yield joint
+            pendingJoints.extend(reversed(joint.children))
 
     def buildJointDict(self, joint):
-        jointDict = {joint.name: joint}
-        for child in joint.children:
-            jointDict.update(self.buildJointDict(child))
-        return jointDict
+        return {joint.name: joint for joint in self.iterJoints(joint)}
 
     def buildJointIndexDict(self, joint, currentChannelIndex=[0]):
-        jointIndexDict = {joint.name: currentChannelIndex[0]}
-        currentChannelIndex[0] += joint.getChannelCount()
-
-        for child in joint.children:
-            jointIndexDict.update(self.buildJointIndexDict(child, currentChannelIndex))
+        jointIndexDict = {}
+        for joint in self.iterJoints(joint):
+            jointIndexDict[joint.name] = currentChannelIndex[0]
+            currentChannelIndex[0] += joint.getChannelCount()
         return jointIndexDict
 
     def getJoint(self, jointName):
@@ -110,15 +385,95 @@ class Skeleton:
         return self.jointIndexes[jointName]
 
 class MotionData:
-    def __init__(self, numFrames, frameTime, frames):
+    def __init__(self, numFrames, frameTime, frames, dtype=None):
         if(numFrames != len(frames)):
             print("WARNING: Number of frames does not match number of frames in data. Taking the length of the motion data.")
+        # Passing a dtype (or an ndarray) stores the motion as one contiguous (numFrames, numChannels) array
+        if(dtype is not None or isinstance(frames, np.ndarray)):
+            frames = np.ascontiguousarray(frames, dtype=dtype if dtype is not None else frames.dtype)
+            if(frames.ndim != 2):
+                frames = frames.reshape(len(frames), -1 if frames.size > 0 else 0)
         self.numFrames = len(frames)
         self.frameTime = frameTime
         self.frames = frames
+        self.frameBuffer = None
+        self.shared = False
+        # Incremented on every write through addFrame/setValues, so cached values derived from the frames can be invalidated
+        self.version = 0
+
+    def isArray(self):
+        return isinstance(self.frames, np.ndarray)
+
+    def shareFrames(self, frames):
+        # Returns a read-only view of the frames for a copy or a slice. This motion keeps its own (writable) array, but it is marked
+        # as shared, so its next write through addFrame/setValues copies the frames first and the copies and slices never see it.
+        self.shared = True
+        sharedFrames = frames.view()
+        sharedFrames.flags.writeable = False
+        return sharedFrames
+
+    def makeFramesWritable(self):
+        if(self.shared):
+            self.frames = np.array(self.frames)
+            self.shared = False
+        return self.frames
+
+    def copy(self):
+        # Array motions share their frames until one of the copies is written to. List motions copy the frames.
+        if(self.isArray()):
+            motionCopy = MotionData(self.numFrames, self.frameTime, self.shareFrames(self.frames))
+            motionCopy.shared = True
+        else:
+            motionCopy = MotionData(self.numFrames, self.frameTime, [list(frame) for frame in self.frames])
+        return motionCopy
+
+    def getSlice(self, startFrame, endFrame):
+        if(self.isArray()):
+            frames = self.shareFrames(self.getFrameSlice(startFrame, endFrame))
+        else:
+            frames = [list(frame) for frame in self.getFrameSlice(startFrame, endFrame)]
+        motionSlice = MotionData(len(frames), self.frameTime, frames)
+        motionSlice.shared = self.isArray()
+        return motionSlice
+
+    def getFramesArray(self):
+        if(self.isArray()):
+            return self.frames
+        return np.array(self.frames, dtype=np.float64)
+
+    def getFramesAt(self, frames):
+        # Array of the frames selected by an index, a slice or a list of indexes. Only the selected frames are converted.
+        if(frames is None):
+            return self.getFramesArray()
+        if(isinstance(frames, slice)):
+            selectedFrames = self.frames[frames]
+        elif(np.ndim(frames) == 0):
+            selectedFrames = [self.frames[frames]]
+        else:
+            frameIndexes = np.asarray(frames)
+            if(frameIndexes.dtype == bool):
+                frameIndexes = np.flatnonzero(frameIndexes)
+            frameIndexes = frameIndexes.reshape(-1)
+            selectedFrames = self.frames[frameIndexes] if self.isArray() else [self.frames[frameIndex] for frameIndex in frameIndexes]
+        if(isinstance(selectedFrames, np.ndarray)):
+            return selectedFrames
+        return np.array(selectedFrames, dtype=np.float64)
 
     def addFrame(self, frameData):
-        self.frames.append(frameData)
+        if(self.isArray()):
+            self.makeFramesWritable()
+            # Frames are appended into a buffer that grows geometrically, so adding frames one by one stays amortized O(1)
+            if(self.frameBuffer is None or self.frames.base is not self.frameBuffer or self.numFrames >= len(self.frameBuffer)):
+                numChannels = self.frames.shape[1] if self.numFrames > 0 else len(frameData)
+                self.frameBuffer = np.empty((max(2 * self.numFrames, 16), numChannels), dtype=self.frames.dtype)
+                if(self.numFrames > 0):
+                    self.frameBuffer[:self.numFrames] = self.frames
+            self.frameBuffer[self.numFrames] = frameData
+            self.frames = self.frameBuffer[:self.numFrames + 1]
+        else:
+            self.frames.append(frameData.tolist() if isinstance(frameData, np.ndarray) else frameData)
+        self.numFrames += 1
+        self.version += 1
 
     def getFrame(self, frameIndex):
         return self.frames[frameIndex]
@@ -127,8 +482,25 @@ class MotionData:
         return self.frames[startFrame:endFrame]
 
     def getValues(self, valueIndex):
+        if(self.isArray()):
+            return self.frames[:, valueIndex]
+        if(isinstance(valueIndex, (list, tuple))):
+            return [[x[i] for i in valueIndex] for x in self.frames]
         return [x[valueIndex] for x in self.frames]
 
+    def setValues(self, valueIndex, values):
+        self.version += 1
+        if(self.isArray()):
+            self.makeFramesWritable()[:, valueIndex] = values
+            return
+        if(isinstance(valueIndex, (list, tuple))):
+            for frame, frameValues in zip(self.frames, values):
+                for i, value in zip(valueIndex, frameValues):
+                    frame[i] = float(value)
+        else:
+            for frame, value in zip(self.frames, values):
+                frame[valueIndex] = float(value)
+
     def getValueAtFrame(self, valueIndex, frame):
         return self.frames[frame][valueIndex]
     
@@ -136,32 +508,113 @@ class MotionData:
         jointIndex = self.skeleton.getJointIndex(jointName)
         return [x[jointIndex:jointIndex.getChannelCount()] for x in self.frames]
 
+def concatenateMotionData(motions):
+    # Joins the motions with a single copy. Frames are always copied, so the result never aliases its inputs.
+    if(all(motion.isArray() for motion in motions)):
+        frames = np.concatenate([motion.getFramesArray() for motion in motions])
+    else:
+        frames = [list(frame) for motion in motions for frame in motion.frames]
+    return MotionData(len(frames), motions[0].frameTime, frames)
+
+class FKCache:
+    # LRU cache of getFKAtFrame results, bounded by a number of frames and/or a number of bytes
+    def __init__(self, maxFrames=None, maxBytes=None):
+        if(maxFrames is None and maxBytes is None):
+            raise Exception("The FK cache needs a maxFrames or a maxBytes limit")
+        self.maxFrames = maxFrames
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.numBytes = 0
+        self.key = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def validate(self, key):
+        # Cached frames are dropped as soon as the skeleton offsets or the motion change
+        if(self.key != key):
+            self.clear()
+            self.key = key
+
+    def clear(self):
+        self.entries.clear()
+        self.numBytes = 0
+
+    def get(self, frame):
+        entry = self.entries.get(frame)
+        if(entry is None):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(frame)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, frame, fkFrame):
+        # Cached arrays are shared between callers, so they are made read-only
+        entrySize = 0
+        for rot, pos in fkFrame.values():
+            rot.flags.writeable = False
+            pos.flags.writeable = False
+            entrySize += rot.nbytes + pos.nbytes
+        if(frame in self.entries):
+            self.numBytes -= self.entries.pop(frame)[1]
+        self.entries[frame] = (fkFrame, entrySize)
+        self.numBytes += entrySize
+        while(len(self.entries) > 0 and ((self.maxFrames is not None and len(self.entries) > self.maxFrames) or (self.maxBytes is not None and self.numBytes > self.maxBytes))):
+            self.numBytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def getStats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "frames": len(self.entries), "bytes": self.numBytes, "maxFrames": self.maxFrames, "maxBytes": self.maxBytes}
+
 class BVHData:
     def __init__(self, skeleton, motion, header):
         self.header = header
         self.skeleton = skeleton
         self.motion = motion
-        self.skeletonDims = self.calculateSkeletonDims()
+        # Dimensions are computed on first use, and cached until the skeleton offsets or the motion change
+        self.skeletonDims = None
+        self.skeletonDimsKey = None
         self.motionDims = None
-        
+        self.motionDimsKey = None
+        self.fkCache = None
+
+
+    def copy(self, motion=None):
+        # The skeleton and header are shared (they are never modified in place), and the motion is copied on write.
+        # A different motion can be given to build e.g. slices without copying this one.
+        bvhCopy = copy.copy(self)
+        bvhCopy.motion = self.motion.copy() if motion is None else motion
+        if(self.fkCache is not None):
+            bvhCopy.fkCache = FKCache(self.fkCache.maxFrames, self.fkCache.maxBytes)
+        return bvhCopy
+
+    def enableFKCache(self, maxFrames=None, maxBytes=None):
+        # Opt-in cache for getFKAtFrame, useful when the same frames are requested many times (viewers, repeated manipulation...)
+        if(maxFrames is None and maxBytes is None):
+            maxFrames = 1024
+        self.fkCache = FKCache(maxFrames, maxBytes)
+
+    def disableFKCache(self):
+        self.fkCache = None
+
+    def getFKCacheStats(self):
+        if(self.fkCache is None):
+            return None
+        return self.fkCache.getStats()
+
+    @profiled()
     def getJointLocalTransformAtFrame(self, jointName, frame, rotationMode = "Euler"):
-        joint = self.skeleton.getJoint(jointName)
-        jointIndex = self.skeleton.getJointIndex(jointName)
+        layout = self.skeleton.getLayout()
+        jointPosition = layout.jointPositions[jointName]
+        frameData = self.motion.getFrame(frame)
         r = None
         Xpos, Ypos, Zpos = 0.0, 0.0, 0.0
-        if("Xrotation" in joint.channels and "Yrotation" in joint.channels and "Zrotation" in joint.channels):
-            rotOrder = joint.getRotationChannelsOrder()
-            angles = []
-            for axis in rotOrder:
-                axisName = axis + "rotation"
-                if(axisName in joint.channels):
-                    idx = jointIndex + joint.channels.index(axisName)
-                    angles.append(self.motion.getValueAtFrame(idx, frame))
-            r = R.from_euler(rotOrder, angles, degrees=True)
-        if("Xposition" in joint.channels and "Yposition" in joint.channels and "Zposition" in joint.channels):
-            Xpos = self.motion.getValueAtFrame(jointIndex + joint.channels.index("Xposition"), frame)
-            Ypos = self.motion.getValueAtFrame(jointIndex + joint.channels.index("Yposition"), frame)
-            Zpos = self.motion.getValueAtFrame(jointIndex + joint.channels.index("Zposition"), frame)
+        if(layout.hasRotation[jointPosition]):
+            angles = [frameData[column] for column in layout.rotationColumns[jointPosition]]
+            r = R.from_euler(layout.rotationOrders[jointPosition], angles, degrees=True)
+        if(layout.hasPosition[jointPosition]):
+            Xpos, Ypos, Zpos = [frameData[column] for column in layout.positionColumns[jointPosition]]
 
         if(r is None):
             if(rotationMode == "Euler"):
@@ -178,23 +631,17 @@ class BVHData:
             if(rotationMode == "Matrix"):
                 return r.as_matrix(), [Xpos, Ypos, Zpos]
 
-    def calculateSkeletonDims(self):
-        minX, minY, minZ = float('inf'), float('inf'), float('inf')
-        maxX, maxY, maxZ = float('-inf'), float('-inf'), float('-inf')
-
-        fkData0 = self.getFKAtFrame(0)
-        for jointName, (rot, pos) in fkData0.items():
-            # Extract the position of each joint
-            x, y, z = pos
-            
-            # Update the min and max values for each axis (X, Y, Z)
-            minX = min(minX, x)
-            minY = min(minY, y)
-            minZ = min(minZ, z)
+    def getDimsKey(self):
+        # The layout is rebuilt whenever the offsets change, and the motion version whenever the frames are written
+        return (self.skeleton.getLayout(), self.motion, self.motion.version)
 
-            maxX = max(maxX, x)
-            maxY = max(maxY, y)
-            maxZ = max(maxZ, z)
+    def calculateSkeletonDims(self):
+        # Only the first frame is read, so lazy and list motions are not converted as a whole
+        layout = self.skeleton.getLayout()
+        frameArray = np.asarray(self.motion.getFrameSlice(0, 1), dtype=np.float64).reshape(-1, layout.numChannels)
+        jointPositions0 = computeFKInto(layout, frameArray, np.empty((1, layout.numJoints, 3, 3)), np.empty((1, layout.numJoints, 3)))[1][0]
+        minX, minY, minZ = jointPositions0.min(axis=0).tolist()
+        maxX, maxY, maxZ = jointPositions0.max(axis=0).tolist()
 
         # Calculate height, width, and depth
         height = maxY - minY  # Difference in the Y-axis (vertical)
@@ -204,39 +651,44 @@ class BVHData:
         return [height, width, depth]
 
     def getSkeletonDim(self, dimName):
-        if(dimName == "width"):
-            return self.skeletonDims[0]
+        # The dimensions are stored as [height, width, depth]
         if(dimName == "height"):
-            return self.skeletonDims[1]
+            return self.getSkeletonDims()[0]
+        if(dimName == "width"):
+            return self.getSkeletonDims()[1]
         if(dimName == "depth"):
-            return self.skeletonDims[2]
+            return self.getSkeletonDims()[2]
 
     def getSkeletonDims(self):
+        dimsKey = self.getDimsKey()
+        if(self.skeletonDims is None or self.skeletonDimsKey != dimsKey):
+            self.skeletonDims = self.calculateSkeletonDims()
+            self.skeletonDimsKey = dimsKey
         return self.skeletonDims
+
+    def inheritSkeletonDims(self, sourceBvh):
+        # Used by slices: they keep the dimensions of the clip they were cut from until their skeleton or motion change.
+        # The dimensions are computed once on the source (one frame of FK) and copied, so slices do not keep the source alive.
+        self.skeletonDims = list(sourceBvh.getSkeletonDims())
+        self.skeletonDimsKey = self.getDimsKey()
     
     def calculateMotionDims(self):
-        minX, minY, minZ = float('inf'), float('inf'), float('inf')
-        maxX, maxY, maxZ = float('-inf'), float('-inf'), float('-inf')
-
-        for frameIndex in range(self.motion.numFrames):
-            fkDataRoot = self.getFKAtFrame(frameIndex)[self.skeleton.root.name][1]
-            # Extract the position of each joint
-            x, y, z = fkDataRoot
-            
-            # Update the min and max values for each axis (X, Y, Z)
-            minX = min(minX, x)
-            minY = min(minY, y)
-            minZ = min(minZ, z)
-
-            maxX = max(maxX, x)
-            maxY = max(maxY, y)
-            maxZ = max(maxZ, z)
+        # The global position of the root is its position channels, so no FK (and no rotation matrices) is needed
+        layout = self.skeleton.getLayout()
+        if(layout.hasPosition[0]):
+            rootPositions = np.asarray(self.motion.getValues(layout.positionColumns[0].tolist()), dtype=np.float64).reshape(-1, 3)
+        else:
+            rootPositions = np.zeros((1, 3))
+        minX, minY, minZ = rootPositions.min(axis=0)
+        maxX, maxY, maxZ = rootPositions.max(axis=0)
 
-        return [minX, maxX, minY, maxY, minZ, maxZ]
+        return [float(minX), float(maxX), float(minY), float(maxY), float(minZ), float(maxZ)]
 
     def getMotionDims(self):
-        if(self.motionDims is None):
+        dimsKey = self.getDimsKey()
+        if(self.motionDims is None or self.motionDimsKey != dimsKey):
             self.motionDims = self.calculateMotionDims()
+            self.motionDimsKey = dimsKey
         return self.motionDims
     
     def getChildFKAtFrame(self, joint, frame, parentTransform, fkFrame):
@@ -251,33 +703,137 @@ class BVHData:
         for child in joint.children:
             self.getChildFKAtFrame(child, frame, (jointGlobalRot, jointGlobalPos), fkFrame)
 
+    @profiled(frames=1)
     def getFKAtFrame(self, frame):
+        if(self.fkCache is not None):
+            frame = int(frame) if frame >= 0 else int(frame) + self.motion.numFrames
+            self.fkCache.validate(self.getDimsKey())
+            fkFrame = self.fkCache.get(frame)
+            if(fkFrame is not None):
+                return dict(fkFrame)
         rootJoint = self.skeleton.root
         rootLocalRot, rootLocalPos = self.getJointLocalTransformAtFrame(rootJoint.name, frame, "Matrix")
+        rootLocalPos = np.array(rootLocalPos, dtype=np.float64)
         fkFrame = {rootJoint.name: (rootLocalRot, rootLocalPos)}
         for child in rootJoint.children:
             self.getChildFKAtFrame(child, frame, (rootLocalRot, rootLocalPos), fkFrame)
+        if(self.fkCache is not None):
+            self.fkCache.put(frame, fkFrame)
+            return dict(fkFrame)
         return fkFrame
     
+    def getLocalRotationMatricesAllFrames(self, frameArray):
+        layout = self.skeleton.getLayout()
+        return computeLocalRotationMatrices(layout, frameArray, np.empty((frameArray.shape[0], layout.numJoints, 3, 3)))
+
+    @profiled(frames=lambda arguments, result: len(result))
+    def getLocalRotations(self, representation="Quaternion", frames=None):
+        # Local rotations of all the joints (in skeleton.joints order) for all the frames, converted with one batch per rotation order.
+        # Euler: (frames, joints, 3) in the rotation order of each joint. Quaternion: (frames, joints, 4) as (x, y, z, w).
+        # Matrix: (frames, joints, 3, 3). 6D: (frames, joints, 6), the first two columns of the matrices.
+        # Joints without rotation channels get the identity rotation.
+        layout = self.skeleton.getLayout()
+        frameArray = self.motion.getFramesArray()
+        if(frames is not None):
+            frameArray = frameArray[frames]
+        frameArray = np.asarray(frameArray, dtype=np.float64).reshape(-1, layout.numChannels)
+        numFrames = frameArray.shape[0]
+        if(representation == "Euler"):
+            rotations = np.zeros((numFrames, layout.numJoints, 3))
+            for groupJoints, groupColumns in layout.rotationGroups.values():
+                rotations[:, groupJoints] = frameArray[:, groupColumns]
+        elif(representation == "Quaternion"):
+            rotations = np.zeros((numFrames, layout.numJoints, 4))
+            rotations[..., 3] = 1.0
+            for rotOrder, (groupJoints, groupColumns) in layout.rotationGroups.items():
+                rotations[:, groupJoints] = eulerToQuaternions(rotOrder, frameArray[:, groupColumns])
+        elif(representation == "Matrix"):
+            rotations = self.getLocalRotationMatricesAllFrames(frameArray)
+        elif(representation == "6D"):
+            rotations = matricesToRotation6D(self.getLocalRotationMatricesAllFrames(frameArray))
+        else:
+            raise Exception(f"Unknown rotation representation ({representation}). Use 'Euler', 'Quaternion', 'Matrix' or '6D'")
+        return rotations
+
+    @profiled(frames=lambda arguments, result: len(arguments["rotations"]))
+    def setLocalRotations(self, rotations, representation="Quaternion"):
+        # Inverse of getLocalRotations: writes (frames, joints, ...) rotations of all the frames back into the rotation channels.
+        # The Euler angles closest to the current channel values are written, so unchanged rotations keep their values.
+        layout = self.skeleton.getLayout()
+        rotations = np.asarray(rotations, dtype=np.float64)
+        expectedShapes = {"Euler": (3,), "Quaternion": (4,), "Matrix": (3, 3), "6D": (6,)}
+        if(representation not in expectedShapes):
+            raise Exception(f"Unknown rotation representation ({representation}). Use 'Euler', 'Quaternion', 'Matrix' or '6D'")
+        expectedShape = (self.motion.numFrames, layout.numJoints) + expectedShapes[representation]
+        if(rotations.shape != expectedShape):
+            raise Exception(f"The rotations must have shape {expectedShape} for {representation}, not {rotations.shape}")
+        frameArray = self.motion.getFramesArray()
+        for rotOrder, (groupJoints, groupColumns) in layout.rotationGroups.items():
+            groupRotations = rotations[:, groupJoints]
+            if(representation == "Euler"):
+                angles = groupRotations
+            else:
+                if(representation == "Quaternion"):
+                    angles = quaternionsToEuler(rotOrder, groupRotations)
+                elif(representation == "Matrix"):
+                    angles = matricesToEuler(rotOrder, groupRotations)
+                else:
+                    angles = matricesToEuler(rotOrder, rotation6DToMatrices(groupRotations))
+                angles = getClosestEulerAngles(angles, np.asarray(frameArray[:, groupColumns], dtype=np.float64))
+            self.motion.setValues(groupColumns.reshape(-1).tolist(), angles.reshape(self.motion.numFrames, -1))
+
+    @profiled(frames=lambda arguments, result: len(result[1]))
+    def getFKAllFrames(self, frames=None, workers=1, chunkSize=None, executor="thread"):
+        layout = self.skeleton.getLayout()
+        # Only the requested frames are converted (or parsed, for lazy motions)
+        frameArray = np.ascontiguousarray(self.motion.getFramesAt(frames).reshape(-1, layout.numChannels), dtype=np.float64)
+        numFrames = frameArray.shape[0]
+
+        # Long clips can be split into chunks (less temporary memory) evaluated by several threads or processes
+        if(workers != 1 or chunkSize is not None):
+            return computeFKParallel(layout, frameArray, workers, chunkSize, executor)
+        return computeFKInto(layout, frameArray, np.empty((numFrames, layout.numJoints, 3, 3)), np.empty((numFrames, layout.numJoints, 3)))
+
     def getFKAtFrameNormalized(self, frame, skeletonDim = "height"):
-        fkFrame = self.getFKAtFrame(frame)
         normalizer = self.getSkeletonDim(skeletonDim)
-        for jointName, (rot, pos) in fkFrame.items():
-            fkFrame[jointName] = (rot, pos / normalizer)
-        return fkFrame
+        return {jointName: (rot, pos / normalizer) for jointName, (rot, pos) in self.getFKAtFrame(frame).items()}
     
     def rewriteHeaderOffsets(self):
-        jointName = ""
-        for lineIndex, line in enumerate(self.header):
-            if("ROOT" in line or "JOINT" in line): 
-                jointName = line.split(" ")[-1]
-            if("End Site" in line):
-                jointName = jointName + "_EndSite"
-            
-            if("OFFSET" in line):
-                newValuesFormatted = ['{:+0.6f}'.format(v) if v < 0 else '{:0.6f}'.format(v) for v in self.skeleton.getJoint(jointName).offset]
-                line = re.sub(r'([-+]?\d*\.\d{6})\s+([-+]?\d*\.\d{6})\s+([-+]?\d*\.\d{6})$', ' '.join(newValuesFormatted), line)
-                self.header[lineIndex] = line
+        # The header may be shared with other BVHData objects, so a new one is built.
+        # The offsets may have been edited directly, so the layout (and everything cached from it) is rebuilt too.
+        self.skeleton.resetLayout()
+        self.header = list(self.header)
+        # The OFFSET keywords appear in the same depth-first order as the joints, so no joint names have to be parsed.
+        # Like the parser, this works on tokens, so OFFSET may share its line with braces or other keywords.
+        tokens = [(lineIndex, match.start(), match.end(), match.group()) for lineIndex, line in enumerate(self.header) for match in re.finditer(r"\S+", line)]
+        joints = self.skeleton.iterJoints(self.skeleton.root)
+        replacements = {}
+        tokenIndex = 0
+        while(tokenIndex < len(tokens)):
+            token = tokens[tokenIndex][3]
+            if(token in ("ROOT", "JOINT", "End")):
+                # Joint names are skipped, in case one of them contains the word OFFSET
+                while(tokenIndex < len(tokens) and tokens[tokenIndex][3] != "{"):
+                    tokenIndex += 1
+            elif(token == "OFFSET"):
+                joint = next(joints, None)
+                if(joint is None):
+                    break
+                lineIndex, start = tokens[tokenIndex][0], tokens[tokenIndex][1]
+                valueTokens = tokens[tokenIndex + 1:tokenIndex + 4]
+                newValuesFormatted = ['{:+0.6f}'.format(v) if v < 0 else '{:0.6f}'.format(v) for v in joint.offset]
+                if(len(valueTokens) == 3 and all(valueToken[0] == lineIndex for valueToken in valueTokens)):
+                    replacements.setdefault(lineIndex, []).append((start, valueTokens[-1][2], "OFFSET " + " ".join(newValuesFormatted)))
+                else:
+                    for valueToken, newValue in zip(valueTokens, newValuesFormatted):
+                        replacements.setdefault(valueToken[0], []).append((valueToken[1], valueToken[2], newValue))
+                tokenIndex += 3
+            tokenIndex += 1
+        for lineIndex, lineReplacements in replacements.items():
+            line = self.header[lineIndex]
+            for start, end, text in reversed(lineReplacements):
+                line = line[:start] + text + line[end:]
+            self.header[lineIndex] = line
 
     def getRestPoseJoint(self, joint, canonicalRotation, poseDict):
         poseDict.update({joint.name: joint.getRotationFromOffset(canonicalRotation)})
@@ -307,33 +863,42 @@ class BVHData:
             self.applyOffsetToChildren(child, rNew)
 
     def applyRotationToItselfAndChildren(self, joint, oldPose, newPose, rNew):
-        for frame in self.motion.frames:
-            rotationChannels = [0, 1, 2] if("rotation" in joint.channels[0] or "rotation" in joint.channels[1] or "rotation" in joint.channels[2]) else [3, 4, 5]
-            oldRotation = R.from_euler(joint.getRotationChannelsOrder(), [frame[self.skeleton.getJointIndex(joint.name) + rotationChannels[0]],
-                                                                    frame[self.skeleton.getJointIndex(joint.name) + rotationChannels[1]],
-                                                                    frame[self.skeleton.getJointIndex(joint.name) + rotationChannels[2]]], degrees=True)
-            rOld = oldPose[joint.name]
-            newRotation = (rNew * rOld.inv() * oldRotation).as_euler(joint.getRotationChannelsOrder(), degrees = True)
-            frame[self.skeleton.getJointIndex(joint.name) + rotationChannels[0]] = newRotation[0]
-            frame[self.skeleton.getJointIndex(joint.name) + rotationChannels[1]] = newRotation[1]
-            frame[self.skeleton.getJointIndex(joint.name) + rotationChannels[2]] = newRotation[2]
+        layout = self.skeleton.getLayout()
+        jointPosition = layout.jointPositions[joint.name]
+        if(layout.hasRotation[jointPosition] and self.motion.numFrames > 0):
+            rotOrder = layout.rotationOrders[jointPosition]
+            rotationColumns = list(layout.rotationColumns[jointPosition])
+            # The correction is the same for every frame, so it is composed once and applied to the whole column block
+            correction = rNew * oldPose[joint.name].inv()
+            oldRotations = R.from_euler(rotOrder, np.asarray(self.motion.getValues(rotationColumns), dtype=np.float64).reshape(-1, 3), degrees=True)
+            self.motion.setValues(rotationColumns, (correction * oldRotations).as_euler(rotOrder, degrees = True))
         for child in joint.children:
             if(not "_EndSite" in child.name):
                 rNew = newPose[child.name]
                 self.applyRotationToItselfAndChildren(child, oldPose, newPose, rNew)
 
+    @profiled(frames=argumentFrames("self"))
     def setRestPose(self, poseDict):
+        # The skeleton may be shared with other BVHData objects, so the offsets are changed in a copy
+        self.skeleton = copy.deepcopy(self.skeleton)
         oldPose = self.getRestPose()
         newPose = copy.deepcopy(poseDict)
         for poseName, pose in poseDict.items():
             if(poseName in newPose.keys()):
                 newPose[poseName] = R.from_euler('XYZ', poseDict[poseName], degrees=True)
 
+        restPoseComputed = False
         for joint in self.skeleton.joints.values():
             if(joint.name in poseDict.keys()):
                 rNew = newPose[joint.name]
                 self.applyOffsetToChildren(joint, rNew)
-                newPose = self.getRestPose()
+                self.skeleton.resetLayout()
+                if(not restPoseComputed):
+                    newPose = self.getRestPose()
+                    restPoseComputed = True
+                else:
+                    # Only the offsets below this joint changed, so only their rest rotations are recomputed
+                    self.getRestPoseJoint(joint, np.array([0, 1, 0]), newPose)
                 self.applyRotationToItselfAndChildren(joint, oldPose, newPose, rNew)
 
         self.rewriteHeaderOffsets()
\ No newline at end of file
@@ -0,0 +1,113 @@
+import numpy as np
+from scipy.signal import savgol_filter
+from bvhTools.bvhProfiler import profiled, argumentFrames
+
+class MotionFeatures:
+    # Per-frame features of a whole clip, as arrays. FK is computed once, when the object is created.
+    # Joints are selected by name, and the results keep the order of the given names (all joints in skeleton order by default).
+    @profiled(frames=argumentFrames("bvhData"))
+    def __init__(self, bvhData, smoothingWindow=None, polyOrder=2):
+        self.bvhData = bvhData
+        self.layout = bvhData.skeleton.getLayout()
+        self.frameTime = bvhData.motion.frameTime
+        if(self.frameTime <= 0):
+            raise Exception("The motion needs a positive frame time to compute time derivatives")
+        self.globalRots, self.globalPos = bvhData.getFKAllFrames()
+        # Savitzky-Golay windows must be odd and longer than the polynomial order
+        if(smoothingWindow is not None):
+            smoothingWindow = max(smoothingWindow + (1 - smoothingWindow % 2), polyOrder + 1 + polyOrder % 2)
+            if(smoothingWindow > len(self.globalPos)):
+                print(f"WARNING: The smoothing window ({smoothingWindow}) is longer than the clip. No smoothing will be applied.")
+                smoothingWindow = None
+        self.smoothingWindow = smoothingWindow
+        self.polyOrder = polyOrder
+        self.cache = {}
+
+    def getJointPositions(self, jointNames=None):
+        if(jointNames is None):
+            return np.arange(self.layout.numJoints)
+        missingJoints = [jointName for jointName in jointNames if jointName not in self.layout.jointPositions]
+        if(len(missingJoints) > 0):
+            raise Exception(f"Joints not found in skeleton: {', '.join(missingJoints)}")
+        return np.array([self.layout.jointPositions[jointName] for jointName in jointNames], dtype=int)
+
+    def getDerivative(self, order):
+        # Central finite differences (or Savitzky-Golay derivatives when smoothing), in units per second
+        if(order not in self.cache):
+            if(len(self.globalPos) < 2):
+                self.cache[order] = np.zeros_like(self.globalPos)
+            elif(self.smoothingWindow is not None):
+                self.cache[order] = savgol_filter(self.globalPos, self.smoothingWindow, self.polyOrder, deriv=order, delta=self.frameTime, axis=0)
+            else:
+                derivative = self.globalPos
+                for _ in range(order):
+                    derivative = np.gradient(derivative, self.frameTime, axis=0)
+                self.cache[order] = derivative
+        return self.cache[order]
+
+    def getPositions(self, jointNames=None):
+        if(self.smoothingWindow is not None):
+            return self.getDerivative(0)[:, self.getJointPositions(jointNames)]
+        return self.globalPos[:, self.getJointPositions(jointNames)]
+
+    def getVelocities(self, jointNames=None):
+        return self.getDerivative(1)[:, self.getJointPositions(jointNames)]
+
+    def getSpeeds(self, jointNames=None):
+        return np.linalg.norm(self.getVelocities(jointNames), axis=-1)
+
+    def getAccelerations(self, jointNames=None):
+        return self.getDerivative(2)[:, self.getJointPositions(jointNames)]
+
+    def getFootContacts(self, footNames, heightThreshold=None, speedThreshold=None, upAxis=1):
+        # A foot is in contact when it is close to its lowest height in the clip and (almost) not moving.
+        # The default thresholds are relative to the skeleton height: 5% above the lowest point, and 15% of the height per second.
+        skeletonHeight = self.bvhData.getSkeletonDim("height")
+        heights = self.getPositions(footNames)[:, :, upAxis]
+        if(heightThreshold is None):
+            heightThreshold = 0.05 * skeletonHeight
+        if(speedThreshold is None):
+            speedThreshold = 0.15 * skeletonHeight
+        return (heights - heights.min(axis=0) <= heightThreshold) & (self.getSpeeds(footNames) <= speedThreshold)
+
+    def getBoneAngles(self, jointNames=None, degrees=True):
+        # Angle between the bone that arrives to each joint (parent -> joint) and the bone that leaves it (joint -> first child).
+        # Root and leaf joints have no angle (NaN).
+        jointPositions = self.getJointPositions(jointNames)
+        firstChildren = np.full(self.layout.numJoints, -1, dtype=int)
+        for jointPosition in range(self.layout.numJoints - 1, 0, -1):
+            firstChildren[self.layout.parents[jointPosition]] = jointPosition
+        angles = np.full((len(self.globalPos), len(jointPositions)), np.nan)
+        parents = self.layout.parents[jointPositions]
+        children = firstChildren[jointPositions]
+        valid = (parents >= 0) & (children >= 0)
+        if(np.any(valid)):
+            inBones = self.globalPos[:, jointPositions[valid]] - self.globalPos[:, parents[valid]]
+            outBones = self.globalPos[:, children[valid]] - self.globalPos[:, jointPositions[valid]]
+            norms = np.linalg.norm(inBones, axis=-1) * np.linalg.norm(outBones, axis=-1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                cosines = np.clip(np.sum(inBones * outBones, axis=-1) / norms, -1.0, 1.0)
+            angles[:, valid] = np.arccos(cosines)
+        return np.degrees(angles) if degrees else angles
+
+    def getRelativeRotations(self, jointNames=None):
+        # Rotation matrices of every joint relative to its parent in global space (the root keeps its global rotation)
+        jointPositions = self.getJointPositions(jointNames)
+        parents = self.layout.parents[jointPositions]
+        relativeRots = self.globalRots[:, jointPositions].copy()
+        hasParent = parents >= 0
+        relativeRots[:, hasParent] = np.matmul(np.swapaxes(self.globalRots[:, parents[hasParent]], -1, -2), self.globalRots[:, jointPositions[hasParent]])
+        return relativeRots
+
+    def getFeatures(self, jointNames=None, footNames=None):
+        # All the features in one dictionary, e.g. to be stacked as a model input
+        features = {
+            "positions": self.getPositions(jointNames),
+            "velocities": self.getVelocities(jointNames),
+            "speeds": self.getSpeeds(jointNames),
+            "accelerations": self.getAccelerations(jointNames),
+            "boneAngles": self.getBoneAngles(jointNames),
+        }
+        if(footNames is not None):
+            features["footContacts"] = self.getFootContacts(footNames)
+        return features
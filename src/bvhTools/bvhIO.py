@@ -1,136 +1,804 @@
+import io
+import os
+import glob
+import gzip
+import json
+import mmap
+import shutil
+import hashlib
+import tempfile
+import itertools
+import contextlib
+import concurrent.futures
+import numpy as np
 from bvhTools.bvhDataTypes import Joint, Skeleton, MotionData, BVHData
+from bvhTools.bvhProfiler import profiled, resultFrames, argumentFrames
 
-def checkJointForPosition(joint, rootJoint, nonRootJointsWithPos):
-    if joint != rootJoint and any(ch in joint.channels for ch in ["Xposition", "Yposition", "Zposition"]):
-        nonRootJointsWithPos.append(joint.name)
-    for child in joint.children:
-        checkJointForPosition(child, rootJoint, nonRootJointsWithPos)
+def checkJointForPosition(skeleton):
+    return [joint.name for joint in skeleton.iterJoints(skeleton.root) if joint != skeleton.root and any(ch in joint.channels for ch in ["Xposition", "Yposition", "Zposition"])]
 
-def buildBvhStructure(header, motion, numFrames, frameTime):
-    currentIndex = 0
+@profiled()
+def parseHierarchy(header):
+    # Single pass over the whitespace-separated tokens of the header, with an explicit stack of open joints instead of recursion.
+    # Any indentation (tabs, several spaces, braces on the same line) is accepted, and deep hierarchies are parsed in linear time.
+    tokens = " ".join(header).split()
+    tokenIndex = tokens.index("ROOT") if "ROOT" in tokens else -1
+    if(tokenIndex < 0):
+        raise Exception("No ROOT joint found in the BVH hierarchy")
     rootJoint = None
-    while(currentIndex < len(header)):
-        if("ROOT" in header[currentIndex]):
-            rootJoint, newIndex = readJoint(header, currentIndex)
-            currentIndex = newIndex
-            break
-        currentIndex += 1
-    skeleton = Skeleton(rootJoint)
+    openJoints = []
+    while(tokenIndex < len(tokens)):
+        token = tokens[tokenIndex]
+        if(token in ("ROOT", "JOINT", "End")):
+            if((token == "ROOT") != (len(openJoints) == 0) or (token == "ROOT" and rootJoint is not None)):
+                raise Exception(f"Unexpected {token} in the BVH hierarchy")
+            # The joint name is everything up to the opening brace. End Sites are named after their parent.
+            try:
+                braceIndex = tokens.index("{", tokenIndex)
+            except ValueError:
+                raise Exception(f"Missing '{{' after {token} in the BVH hierarchy")
+            parent = openJoints[-1] if token != "ROOT" else None
+            jointName = f"{parent.name}_EndSite" if token == "End" else " ".join(tokens[tokenIndex + 1:braceIndex])
+            joint = Joint(name=jointName, offset=None, channels=[], parent=parent)
+            if(parent is None):
+                rootJoint = joint
+            else:
+                parent.addChild(joint)
+            openJoints.append(joint)
+            tokenIndex = braceIndex + 1
+        elif(token == "OFFSET" and len(openJoints) > 0):
+            try:
+                openJoints[-1].setOffset([float(x) for x in tokens[tokenIndex + 1:tokenIndex + 4]])
+            except ValueError:
+                raise Exception(f"Invalid OFFSET for joint {openJoints[-1].name}")
+            tokenIndex += 4
+        elif(token == "CHANNELS" and len(openJoints) > 0):
+            try:
+                numChannels = int(tokens[tokenIndex + 1])
+            except (ValueError, IndexError):
+                raise Exception(f"Invalid CHANNELS for joint {openJoints[-1].name}")
+            openJoints[-1].setChannels(tokens[tokenIndex + 2:tokenIndex + 2 + numChannels])
+            tokenIndex += 2 + numChannels
+        elif(token == "}" and len(openJoints) > 0):
+            joint = openJoints.pop()
+            if(joint.offset is None or len(joint.offset) != 3):
+                raise Exception(f"Joint {joint.name} needs an OFFSET with 3 values")
+            tokenIndex += 1
+            if(len(openJoints) == 0):
+                break
+        else:
+            raise Exception(f"Unexpected token '{token}' in the BVH hierarchy")
+    if(len(openJoints) > 0):
+        raise Exception(f"The BVH hierarchy ends before joint {openJoints[-1].name} is closed")
+    return rootJoint
+
+def buildSkeleton(header, warn=True):
+    skeleton = Skeleton(parseHierarchy(header))
     # Check if any the BVH joints have position channels, and throw a warning if so
-    nonRootJointsWithPos = []
-    checkJointForPosition(skeleton.root, rootJoint, nonRootJointsWithPos)
-    if len(nonRootJointsWithPos) > 0:
+    nonRootJointsWithPos = checkJointForPosition(skeleton)
+    if warn and len(nonRootJointsWithPos) > 0:
         print(f"WARNING: The following joints have position channels: {', '.join(nonRootJointsWithPos)}. \nTheir positions will be ignored when calculating FK.\n")
+    return skeleton
+
+# Skeletons and headers shared by every BVHData read with shareSkeleton=True, keyed by the hierarchy text.
+# BVHData never modifies them in place (setRestPose and rewriteHeaderOffsets replace them), so sharing them is safe.
+SKELETON_REGISTRY = {}
+
+def internSkeleton(header, warn=True):
+    hierarchyKey = "\n".join(header)
+    if(hierarchyKey not in SKELETON_REGISTRY):
+        SKELETON_REGISTRY[hierarchyKey] = (buildSkeleton(header, warn), list(header))
+    return SKELETON_REGISTRY[hierarchyKey]
 
-    motionData = MotionData(numFrames=numFrames, frameTime=frameTime, frames = motion)
+def clearSkeletonRegistry():
+    SKELETON_REGISTRY.clear()
+
+@profiled(frames=resultFrames)
+def buildBvhStructure(header, motion, numFrames, frameTime, dtype=None):
+    skeleton = buildSkeleton(header)
+    motionData = MotionData(numFrames=numFrames, frameTime=frameTime, frames = motion, dtype = dtype)
     bvh = BVHData(skeleton=skeleton, motion=motionData, header = header)
     return bvh
 
-def readEndSite(header, currentIndex, parent):
-    currentIndex += 1
-    while(currentIndex < len(header)):
-        if("{" in header[currentIndex]):
-            currentIndex += 1
-        if("OFFSET" in header[currentIndex]):
-            offset = [float(x) for x in header[currentIndex].split(" ")[1:]]
-            currentIndex += 1
-        if("}" in header[currentIndex]):
-            currentIndex += 1
+def findMalformedMotionLine(motionLines, numChannels, firstLineNumber):
+    for lineOffset, line in enumerate(motionLines):
+        values = line.split()
+        if(len(values) == 0):
+            continue
+        if(len(values) != numChannels):
+            return firstLineNumber + lineOffset, f"expected {numChannels} values, found {len(values)}"
+        for value in values:
+            try:
+                float(value)
+            except ValueError:
+                return firstLineNumber + lineOffset, f"invalid value '{value}'"
+    return None, None
+
+@profiled(frames=lambda arguments, result: len(result))
+def parseMotionBlock(motionLines, numChannels, firstLineNumber, dtype=np.float64):
+    # Parse the whole numeric block in one call. Only if it fails, scan it line by line to report where.
+    while(len(motionLines) > 0 and motionLines[-1].strip() == ""):
+        motionLines = motionLines[:-1]
+    if(len(motionLines) == 0):
+        return np.zeros((0, numChannels), dtype=dtype)
+    try:
+        motion = np.loadtxt(motionLines, dtype=dtype, ndmin=2)
+    except ValueError:
+        motion = None
+    if(motion is None or (motion.size > 0 and motion.shape[1] != numChannels)):
+        lineNumber, reason = findMalformedMotionLine(motionLines, numChannels, firstLineNumber)
+        raise Exception(f"Malformed motion data at line {lineNumber}: {reason}")
+    return motion
+
+class LazyMotionData(MotionData):
+    # Motion data that stays in the (memory-mapped) BVH file. Frames are only parsed when requested.
+    def __init__(self, bvhFile, motionMap, frameIndex, frameTime, numChannels, dtype=np.float64):
+        self.bvhFile = bvhFile
+        self.motionMap = motionMap
+        self.frameIndex = frameIndex
+        self.numFrames = len(frameIndex)
+        self.frameTime = frameTime
+        self.numChannels = numChannels
+        self.dtype = dtype
+        self.lastFrame = (None, None)
+        self.version = 0
+
+    @property
+    def frames(self):
+        return self.getFrameSlice(0, self.numFrames)
+
+    def close(self):
+        self.motionMap.close()
+        self.bvhFile.close()
+
+    def load(self):
+        return MotionData(self.numFrames, self.frameTime, self.frames)
+
+    def copy(self):
+        return self.load()
+
+    def getSlice(self, startFrame, endFrame):
+        frames = self.getFrameSlice(startFrame, endFrame)
+        return MotionData(len(frames), self.frameTime, frames)
+
+    def __deepcopy__(self, memo):
+        return self.load()
+
+    def isArray(self):
+        return True
+
+    def addFrame(self, frameData):
+        raise Exception("Lazy motion data is read-only. Use motion.load() to get an in-memory copy")
+
+    def setValues(self, valueIndex, values):
+        raise Exception("Lazy motion data is read-only. Use motion.load() to get an in-memory copy")
+
+    def getFrame(self, frameIndex):
+        frameIndex = range(self.numFrames)[frameIndex]
+        # Keep the last frame, as FK reads one value at a time
+        if(self.lastFrame[0] != frameIndex):
+            self.lastFrame = (frameIndex, self.getFrameSlice(frameIndex, frameIndex + 1)[0])
+        return self.lastFrame[1]
+
+    def getFrameSlice(self, startFrame, endFrame):
+        frameRange = range(self.numFrames)[startFrame:endFrame]
+        if(len(frameRange) == 0):
+            return np.zeros((0, self.numChannels), dtype=self.dtype)
+        startByte, _, firstLineNumber = self.frameIndex[frameRange.start]
+        endByte = self.frameIndex[frameRange.stop - 1][1]
+        motionLines = self.motionMap[startByte:endByte].decode().split("\n")
+        return parseMotionBlock(motionLines, self.numChannels, int(firstLineNumber), self.dtype)
+
+    def getValueAtFrame(self, valueIndex, frame):
+        return self.getFrame(frame)[valueIndex]
+
+    def getFramesAt(self, frames):
+        # Contiguous ranges are parsed in one block, other selections frame by frame
+        if(frames is None):
+            return self.frames
+        if(isinstance(frames, slice)):
+            frameRange = range(self.numFrames)[frames]
+            if(frameRange.step == 1):
+                return self.getFrameSlice(frameRange.start, frameRange.stop)
+            frameIndexes = list(frameRange)
+        else:
+            frameIndexes = np.asarray(frames)
+            if(frameIndexes.dtype == bool):
+                frameIndexes = np.flatnonzero(frameIndexes)
+            frameIndexes = frameIndexes.reshape(-1)
+        if(len(frameIndexes) == 0):
+            return np.zeros((0, self.numChannels), dtype=self.dtype)
+        return np.stack([self.getFrame(int(frameIndex)) for frameIndex in frameIndexes])
+
+def buildFrameIndex(motionMap, dataStart, firstLineNumber, chunkSize=1 << 26):
+    # Byte offsets of every line of the motion section, scanned in chunks so the file is never fully loaded
+    lineEnds = []
+    for chunkStart in range(dataStart, len(motionMap), chunkSize):
+        chunk = np.frombuffer(motionMap, dtype=np.uint8, count=min(chunkSize, len(motionMap) - chunkStart), offset=chunkStart)
+        lineEnds.append(np.flatnonzero(chunk == ord("\n")) + chunkStart)
+        del chunk
+    lineEnds = np.concatenate(lineEnds + [np.array([len(motionMap)], dtype=np.int64)]).astype(np.int64)
+    lineStarts = np.concatenate([[dataStart], lineEnds[:-1] + 1]).astype(np.int64)
+    lineNumbers = firstLineNumber + np.arange(len(lineStarts), dtype=np.int64)
+    # Drop the lines without any value (e.g. the trailing newline, or only spaces), which the eager reader skips as well
+    hasValues = findLinesWithValues(motionMap, lineStarts, lineEnds, chunkSize)
+    return np.stack([lineStarts[hasValues], lineEnds[hasValues], lineNumbers[hasValues]], axis=1)
+
+def findLinesWithValues(motionMap, lineStarts, lineEnds, chunkSize):
+    # True for the lines with at least one non-whitespace byte. Only the lines starting with whitespace have to be scanned, which
+    # is done in chunks of whole lines, reducing the bytes of every line at once.
+    isValueByte = np.ones(256, dtype=bool)
+    isValueByte[list(b" \t\r\n\v\f")] = False
+    hasValues = lineEnds > lineStarts
+    mapBytes = np.frombuffer(motionMap, dtype=np.uint8)
+    hasValues[hasValues] = isValueByte[mapBytes[lineStarts[hasValues]]]
+    candidates = np.flatnonzero((lineEnds > lineStarts) & ~hasValues)
+    candidateStarts = lineStarts[candidates]
+    firstCandidate = 0
+    while(firstCandidate < len(candidates)):
+        # Whole lines starting within chunkSize bytes of the first one (at least one line, however long)
+        chunkStart = candidateStarts[firstCandidate]
+        lastCandidate = max(firstCandidate + 1, int(np.searchsorted(candidateStarts, chunkStart + chunkSize)))
+        chunkLines = candidates[firstCandidate:lastCandidate]
+        chunk = mapBytes[chunkStart:lineEnds[chunkLines[-1]]]
+        # Every line is one segment, and the bytes between two lines another one, which is skipped
+        bounds = np.stack([lineStarts[chunkLines], lineEnds[chunkLines]], axis=1).ravel()[:-1] - chunkStart
+        hasValues[chunkLines] = np.logical_or.reduceat(isValueByte[chunk], bounds)[::2]
+        del chunk
+        firstCandidate = lastCandidate
+    del mapBytes
+    return hasValues
+
+# Version 2 drops the whitespace-only lines, so the indexes saved before are rebuilt
+FRAME_INDEX_VERSION = 2
+
+def loadFrameIndex(indexPath, sourceStat):
+    if(not os.path.exists(indexPath)):
+        return None
+    with np.load(indexPath) as index:
+        if("version" not in index or int(index["version"]) != FRAME_INDEX_VERSION):
+            return None
+        if(int(index["sourceSize"]) != sourceStat.st_size or int(index["sourceMtime"]) != sourceStat.st_mtime_ns):
+            return None
+        return index["frameIndex"]
+
+def saveFrameIndex(indexPath, frameIndex, sourceStat):
+    try:
+        with open(indexPath, "wb") as f:
+            np.savez(f, version=FRAME_INDEX_VERSION, frameIndex=frameIndex, sourceSize=sourceStat.st_size, sourceMtime=sourceStat.st_mtime_ns)
+    except OSError:
+        print(f"WARNING: Could not write the frame index to {indexPath}")
+
+def readBvhLazy(bvhPath, dtype=np.float64, saveIndex=True):
+    bvhFile = open(bvhPath, "rb")
+    motionMap = mmap.mmap(bvhFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # read and process the header
+    motionStart = motionMap.find(b"MOTION")
+    if(motionStart == -1):
+        motionMap.close()
+        bvhFile.close()
+        raise Exception(f"No MOTION section found in {bvhPath}")
+    motionStart = motionMap.rfind(b"\n", 0, motionStart) + 1
+    header = [line.rstrip("\r") for line in motionMap[:motionStart].decode().split("\n")[:-1]]
+    lineNumber = len(header) + 1
+
+    # read the frame count and frame time
+    numFrames = 0
+    frameTime = 0.0
+    dataStart = motionStart
+    while(dataStart < len(motionMap)):
+        lineEnd = motionMap.find(b"\n", dataStart)
+        lineEnd = len(motionMap) if lineEnd == -1 else lineEnd
+        line = motionMap[dataStart:lineEnd].decode()
+        if("Frames:" in line):
+            numFrames = int(line.split()[1])
+        elif("Frame Time:" in line):
+            frameTime = float(line.split()[2])
+        elif("MOTION" not in line):
             break
-    
-    endSite = Joint(name = f"{parent.name}_EndSite", offset=offset, channels = [], parent=parent)
-
-    return endSite, currentIndex
-        
-def readJoint(header, currentIndex, parent=None):
-    jointName = header[currentIndex].split(" ")[1]
-    currentIndex += 1
-    jointObject = Joint(name = jointName, offset=None, channels=[], parent = parent)
-
-    while(currentIndex < len(header)):
-        if("{" in header[currentIndex]):
-            currentIndex += 1
-        
-        if("OFFSET" in header[currentIndex]):
-            jointObject.setOffset([float(x) for x in header[currentIndex].rstrip().split(" ")[1:]])
-            currentIndex += 1
-        
-        if("CHANNELS" in header[currentIndex]):
-            jointObject.setChannels([str(x) for x in header[currentIndex].rstrip().split(" ")[2:]])
-            currentIndex += 1
-        
-        if("JOINT" in header[currentIndex]):
-            childJoint, currentIndex = readJoint(header, currentIndex, jointObject)
-            jointObject.addChild(childJoint)
-
-        if("End Site" in header[currentIndex]):
-            endSite, currentIndex = readEndSite(header, currentIndex, jointObject)
-            jointObject.addChild(endSite)
-        
-        if("}" in header[currentIndex]):
-            currentIndex += 1
+        dataStart = lineEnd + 1
+        lineNumber += 1
+
+    skeleton = buildSkeleton(header)
+    numChannels = skeleton.getLayout().numChannels
+
+    indexPath = str(bvhPath) + ".index.npz"
+    sourceStat = os.stat(bvhPath)
+    frameIndex = loadFrameIndex(indexPath, sourceStat)
+    if(frameIndex is None):
+        frameIndex = buildFrameIndex(motionMap, dataStart, lineNumber)
+        if(saveIndex):
+            saveFrameIndex(indexPath, frameIndex, sourceStat)
+    if(numFrames != len(frameIndex)):
+        print("WARNING: Number of frames does not match number of frames in data. Taking the length of the motion data.")
+
+    motionData = LazyMotionData(bvhFile, motionMap, frameIndex, frameTime, numChannels, dtype)
+    return BVHData(skeleton=skeleton, motion=motionData, header=header)
+
+BVH_CACHE_MAGIC = b"BVHCACHE"
+BVH_CACHE_VERSION = 1
+
+def getFileHash(path):
+    fileHash = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+def getSourceInfo(sourcePath):
+    sourceStat = os.stat(sourcePath)
+    return {"size": sourceStat.st_size, "mtime": sourceStat.st_mtime_ns, "sha1": getFileHash(sourcePath)}
+
+def buildSkeletonFromJointList(jointList):
+    joints = []
+    for jointInfo in jointList:
+        parent = joints[jointInfo["parent"]] if jointInfo["parent"] >= 0 else None
+        joint = Joint(name=jointInfo["name"], offset=jointInfo["offset"], channels=jointInfo["channels"], parent=parent)
+        if(parent is not None):
+            parent.addChild(joint)
+        joints.append(joint)
+    return Skeleton(joints[0])
+
+def saveBvhCache(bvhData, cachePath, sourcePath=None):
+    # Layout: magic, metadata length (uint64), JSON metadata, padding to 64 bytes, raw C-ordered motion array
+    motion = np.ascontiguousarray(bvhData.motion.getFramesArray())
+    joints = list(bvhData.skeleton.joints.values())
+    jointPositions = {joint.name: jointPosition for jointPosition, joint in enumerate(joints)}
+    metadata = {
+        "version": BVH_CACHE_VERSION,
+        "header": bvhData.header,
+        "frameTime": bvhData.motion.frameTime,
+        "dtype": motion.dtype.str,
+        "shape": list(motion.shape),
+        "joints": [{"name": joint.name, "parent": jointPositions[joint.parent.name] if joint.parent is not None else -1,
+                    "offset": [float(x) for x in joint.offset], "channels": list(joint.channels)} for joint in joints],
+        "source": getSourceInfo(sourcePath) if sourcePath is not None else None,
+    }
+    with open(cachePath, "wb") as f:
+        writeBinaryHeader(f, BVH_CACHE_MAGIC, metadata)
+        f.write(motion.tobytes())
+
+def writeBinaryHeader(f, magic, metadata):
+    # Layout shared by the binary formats: magic, metadata length (uint64), JSON metadata, padding to 64 bytes. The data starts after the padding.
+    metadataBytes = json.dumps(metadata).encode()
+    dataOffset = len(magic) + 8 + len(metadataBytes)
+    f.write(magic)
+    f.write(len(metadataBytes).to_bytes(8, "little"))
+    f.write(metadataBytes)
+    f.write(b"\0" * ((-dataOffset) % 64))
+    return dataOffset + (-dataOffset) % 64
+
+def readBinaryHeader(path, magic, formatName):
+    with open(path, "rb") as f:
+        if(f.read(len(magic)) != magic):
+            raise Exception(f"{path} is not a {formatName} file")
+        metadataLength = int.from_bytes(f.read(8), "little")
+        metadata = json.loads(f.read(metadataLength).decode())
+    dataOffset = len(magic) + 8 + metadataLength
+    metadata["dataOffset"] = dataOffset + (-dataOffset) % 64
+    return metadata
+
+def rewriteBinaryHeader(path, magic, metadata):
+    # Replaces the metadata of an existing file in place. Only done when the data doesn't move, otherwise the file is left as it is.
+    headerFile = io.BytesIO()
+    dataOffset = writeBinaryHeader(headerFile, magic, {key: value for key, value in metadata.items() if key != "dataOffset"})
+    if(dataOffset != metadata["dataOffset"]):
+        return False
+    with open(path, "r+b") as f:
+        f.write(headerFile.getvalue())
+    return True
+
+def readBvhCacheMetadata(cachePath):
+    return readBinaryHeader(cachePath, BVH_CACHE_MAGIC, "BVH cache")
+
+@profiled(frames=resultFrames, bytesFrom="cachePath")
+def loadBvhCache(cachePath, useMmap=True, shareSkeleton=False):
+    metadata = readBvhCacheMetadata(cachePath)
+    if(metadata["version"] != BVH_CACHE_VERSION):
+        raise Exception(f"Unsupported BVH cache version {metadata['version']} in {cachePath}")
+    shape = tuple(metadata["shape"])
+    if(useMmap and shape[0] > 0):
+        # Copy-on-write mapping: nothing is read until used, and writes never reach the cache file
+        motion = np.memmap(cachePath, dtype=metadata["dtype"], mode="c", offset=metadata["dataOffset"], shape=shape)
+    else:
+        with open(cachePath, "rb") as f:
+            f.seek(metadata["dataOffset"])
+            motion = np.fromfile(f, dtype=metadata["dtype"], count=shape[0] * shape[1]).reshape(shape)
+    header = metadata["header"]
+    if(shareSkeleton):
+        skeleton, header = internSkeleton(header, warn=False)
+    else:
+        skeleton = buildSkeletonFromJointList(metadata["joints"])
+    motionData = MotionData(numFrames=shape[0], frameTime=metadata["frameTime"], frames=motion)
+    return BVHData(skeleton=skeleton, motion=motionData, header=header)
+
+def isBvhCacheValid(cachePath, sourcePath):
+    if(not os.path.exists(cachePath)):
+        return False
+    try:
+        metadata = readBvhCacheMetadata(cachePath)
+    except Exception:
+        return False
+    source = metadata.get("source")
+    if(source is None):
+        return False
+    sourceStat = os.stat(sourcePath)
+    if(source["size"] != sourceStat.st_size):
+        return False
+    if(source["mtime"] == sourceStat.st_mtime_ns):
+        return True
+    # A touched or copied file with the same content is still valid. Its new mtime is stored, so the next load doesn't hash it again.
+    if(source["sha1"] != getFileHash(sourcePath)):
+        return False
+    source["mtime"] = sourceStat.st_mtime_ns
+    try:
+        rewriteBinaryHeader(cachePath, BVH_CACHE_MAGIC, metadata)
+    except OSError:
+        pass
+    return True
+
+@profiled(frames=resultFrames, bytesFrom="bvhPath")
+def readBvh(bvhPath, dtype=None, lazy=False, saveIndex=True, cache=False, shareSkeleton=False):
+    if(lazy):
+        return readBvhLazy(bvhPath, np.float64 if dtype is None else dtype, saveIndex)
+    if(cache):
+        cachePath = str(bvhPath) + ".cache"
+        if(isBvhCacheValid(cachePath, bvhPath)):
+            bvhData = loadBvhCache(cachePath, shareSkeleton=shareSkeleton)
+        else:
+            bvhData = readBvh(bvhPath, np.float64 if dtype is None else dtype, shareSkeleton=shareSkeleton)
+            try:
+                saveBvhCache(bvhData, cachePath, bvhPath)
+            except OSError:
+                print(f"WARNING: Could not write the BVH cache to {cachePath}")
+        if(dtype is not None and bvhData.motion.frames.dtype != dtype):
+            bvhData.motion = MotionData(bvhData.motion.numFrames, bvhData.motion.frameTime, bvhData.motion.frames, dtype)
+        return bvhData
+
+    header, skeleton, numFrames, frameTime, motion = readBvhParts(bvhPath, np.float64 if dtype is None else dtype, shareSkeleton)
+    motionData = MotionData(numFrames=numFrames, frameTime=frameTime, frames=motion if dtype is not None else motion.tolist())
+    return BVHData(skeleton=skeleton, motion=motionData, header=header)
+
+def readBvhParts(bvhPath, dtype=np.float64, shareSkeleton=False):
+    with openTextFile(bvhPath, "r") as f:
+        lines = f.read().split("\n")
+
+    # read and process the header
+    motionIndex = 0
+    while(motionIndex < len(lines) and "MOTION" not in lines[motionIndex]):
+        motionIndex += 1
+    if(motionIndex == len(lines)):
+        raise Exception(f"No MOTION section found in {bvhPath}")
+    header = lines[:motionIndex]
+
+    # read the frame count and frame time, then the whole motion block at once
+    numFrames = 0
+    frameTime = 0.0
+    dataIndex = motionIndex + 1
+    while(dataIndex < len(lines)):
+        if("Frames:" in lines[dataIndex]):
+            numFrames = int(lines[dataIndex].split()[1])
+        elif("Frame Time:" in lines[dataIndex]):
+            frameTime = float(lines[dataIndex].split()[2])
+        else:
             break
+        dataIndex += 1
+
+    if(shareSkeleton):
+        skeleton, header = internSkeleton(header)
+    else:
+        skeleton = buildSkeleton(header)
+    numChannels = skeleton.getLayout().numChannels
+    motion = parseMotionBlock(lines[dataIndex:], numChannels, dataIndex + 1, dtype)
+    return header, skeleton, numFrames, frameTime, motion
+
+@contextlib.contextmanager
+def openBvh(bvhPath, dtype=np.float64, saveIndex=True):
+    bvhData = readBvhLazy(bvhPath, dtype, saveIndex)
+    try:
+        yield bvhData
+    finally:
+        bvhData.motion.close()
+
+def readBvhBatchItem(bvhPath, dtype):
+    # Runs in the worker processes. Only plain data is sent back; the skeletons are rebuilt from the headers.
+    try:
+        header, _, _, frameTime, motion = readBvhParts(bvhPath, dtype)
+        return header, frameTime, motion, None
+    except Exception as e:
+        return None, None, None, f"{type(e).__name__}: {e}"
+
+@profiled(frames=lambda arguments, result: sum(bvhData.motion.numFrames for bvhData in result[0] if bvhData is not None))
+def readBvhBatch(bvhPaths, workers=None, dtype=np.float64, shareSkeleton=False):
+    bvhPaths = [str(bvhPath) for bvhPath in bvhPaths]
+    if(workers == 1 or len(bvhPaths) <= 1):
+        results = [readBvhBatchItem(bvhPath, dtype) for bvhPath in bvhPaths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # map keeps the input order, so the results are deterministic
+            results = list(executor.map(readBvhBatchItem, bvhPaths, itertools.repeat(dtype), chunksize=max(1, len(bvhPaths) // (4 * (workers or os.cpu_count() or 1)))))
 
-    return jointObject, currentIndex
+    bvhDatas = []
+    errors = {}
+    for bvhPath, (header, frameTime, motion, error) in zip(bvhPaths, results):
+        if(error is not None):
+            errors[bvhPath] = error
+            bvhDatas.append(None)
+            continue
+        # Files with the same hierarchy text share one interned skeleton (and header) object
+        if(shareSkeleton):
+            skeleton, header = internSkeleton(header, warn=False)
+        else:
+            skeleton = buildSkeleton(header, warn=False)
+        motionData = MotionData(numFrames=len(motion), frameTime=frameTime, frames=motion)
+        bvhDatas.append(BVHData(skeleton=skeleton, motion=motionData, header=header))
+    return bvhDatas, errors
 
-def readBvh(bvhPath):
+def readBvhDirectory(pattern, workers=None, dtype=np.float64, shareSkeleton=False):
+    if(os.path.isdir(pattern)):
+        pattern = os.path.join(pattern, "**", "*.bvh")
+    bvhPaths = sorted(glob.glob(pattern, recursive=True))
+    bvhDatas, errors = readBvhBatch(bvhPaths, workers, dtype, shareSkeleton)
+    return bvhPaths, bvhDatas, errors
+
+def isGzipPath(path):
+    return str(path).endswith(".gz")
+
+def openTextFile(path, mode, compress=None):
+    # Files ending in .gz (or with compress=True) are read/written through gzip
+    if(compress or (compress is None and isGzipPath(path))):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+def openTextStream(source, mode):
+    # Returns a text stream and whether it was opened here (and so has to be closed here)
+    if(isinstance(source, (str, os.PathLike))):
+        return openTextFile(source, mode), True
+    if(isinstance(source, io.TextIOBase)):
+        return source, False
+    return io.TextIOWrapper(source, write_through=True), False
+
+def releaseTextStream(f, ownsStream, source):
+    # Closes the streams opened here. A wrapper around the caller's binary stream is detached instead, as closing (or just
+    # dropping) the wrapper would close the caller's stream too.
+    if(ownsStream):
+        f.close()
+    elif(f is not source):
+        f.detach()
+    else:
+        f.flush()
+
+def readBvhStreamHeader(f):
     header = []
-    motion = []
+    line = f.readline()
+    while(line != "" and "MOTION" not in line):
+        header.append(line.rstrip("\r\n"))
+        line = f.readline()
+    if(line == ""):
+        raise Exception("No MOTION section found in the BVH stream")
+
     numFrames = 0
     frameTime = 0.0
-
-    with open(bvhPath, "r") as f:
-        # read and process the header
+    lineNumber = len(header) + 2
+    line = f.readline()
+    while(line != ""):
+        if("Frames:" in line):
+            numFrames = int(line.split()[1])
+        elif("Frame Time:" in line):
+            frameTime = float(line.split()[2])
+        else:
+            break
         line = f.readline()
+        lineNumber += 1
+    # The first motion line has already been read, so it is put back in front of the stream
+    return header, numFrames, frameTime, itertools.chain([line], f), lineNumber
+
+def iterBvhFrames(source, chunkSize=None, dtype=np.float64):
+    f, ownsStream = openTextStream(source, "r")
+    try:
+        header, _, _, motionLines, lineNumber = readBvhStreamHeader(f)
+        numChannels = buildSkeleton(header).getLayout().numChannels
+        readSize = chunkSize if chunkSize is not None else 1024
         while(True):
-            if("MOTION" in line):
+            lines = list(itertools.islice(motionLines, readSize))
+            if(len(lines) == 0):
                 break
-            header.append(line.strip("\n"))
-            line = f.readline()
-
-        # read and process the motion data
-        line = f.readline()
-        while(line != ""):
-            if("Frames:" in line):
-                numFrames = int(line.split(" ")[1])
-            elif("Frame Time:" in line):
-                frameTime = float(line.split(" ")[2])
+            chunk = parseMotionBlock(lines, numChannels, lineNumber, dtype)
+            lineNumber += len(lines)
+            if(chunkSize is not None):
+                yield chunk
             else:
-                motion.append([float(x) for x in line.rstrip().replace("\n", "").split(" ")])
-            line = f.readline()
-    bvhData = buildBvhStructure(header, motion, numFrames, frameTime)
-    return bvhData
-
-def writeBvh(bvhData, bvhPath, decimals = 6):
-    with open(bvhPath, "w") as f:
-        for line in bvhData.header:
-            f.write(line)
-            f.write("\n")
+                yield from chunk
+    finally:
+        releaseTextStream(f, ownsStream, source)
+
+def iterBvhChunks(source, chunkSize=1000, dtype=np.float64):
+    f, ownsStream = openTextStream(source, "r")
+    try:
+        header, _, frameTime, motionLines, lineNumber = readBvhStreamHeader(f)
+        skeleton = buildSkeleton(header)
+        numChannels = skeleton.getLayout().numChannels
+        while(True):
+            lines = list(itertools.islice(motionLines, chunkSize))
+            if(len(lines) == 0):
+                break
+            chunk = parseMotionBlock(lines, numChannels, lineNumber, dtype)
+            lineNumber += len(lines)
+            if(len(chunk) > 0):
+                yield BVHData(skeleton=skeleton, motion=MotionData(len(chunk), frameTime, chunk), header=header)
+    finally:
+        releaseTextStream(f, ownsStream, source)
+
+class BvhStreamWriter:
+    # Writes a BVH frame by frame. The "Frames:" line is written with room for any count and patched on close.
+    def __init__(self, bvhPath, header, frameTime, decimals=6, numFrames=None):
+        self.gzipPath = None
+        self.tempPath = None
+        if(isinstance(bvhPath, (str, os.PathLike)) and isGzipPath(bvhPath)):
+            # A gzip stream can't go back to the Frames line, so the text is written to a temporary file and compressed on close
+            self.gzipPath = bvhPath
+            tempHandle, self.tempPath = tempfile.mkstemp(suffix=".bvh", dir=os.path.dirname(os.path.abspath(bvhPath)))
+            self.f, self.ownsStream = open(tempHandle, "w"), True
+        else:
+            self.f, self.ownsStream = openTextStream(bvhPath, "w")
+        self.source = bvhPath
+        canPatch = self.f.seekable() and not isinstance(getattr(self.f, "buffer", None), gzip.GzipFile)
+        if(not canPatch and numFrames is None):
+            releaseTextStream(self.f, self.ownsStream, self.source)
+            raise Exception("The output can't be rewound to write the frame count on close, so numFrames has to be given")
+        self.decimals = decimals
+        self.declaredFrames = numFrames
+        self.numFrames = 0
+        for line in header:
+            self.f.write(line + "\n")
+        self.f.write("MOTION\n")
+        self.framesPosition = self.f.tell() if canPatch else None
+        self.f.write("Frames: " + (str(numFrames or 0).ljust(20) if canPatch else str(numFrames)) + "\n")
+        self.f.write("Frame Time: " + str(frameTime) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def addFrame(self, frame):
+        self.addFrames([frame])
+
+    def addFrames(self, frames):
+        if(len(frames) == 0):
+            return
+        self.f.write(formatFrameBlock(frames, getBvhLineFormat(len(frames[0]), self.decimals)))
+        self.numFrames += len(frames)
+
+    def close(self):
+        if(self.f is None):
+            return
+        if(self.framesPosition is not None):
+            endPosition = self.f.tell()
+            self.f.seek(self.framesPosition)
+            self.f.write("Frames: " + str(self.numFrames).ljust(20))
+            self.f.seek(endPosition)
+        releaseTextStream(self.f, self.ownsStream, self.source)
+        self.f = None
+        if(self.tempPath is not None):
+            with open(self.tempPath, "rb") as source, gzip.open(self.gzipPath, "wb") as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            os.remove(self.tempPath)
+            self.tempPath = None
+        if(self.framesPosition is None and self.declaredFrames != self.numFrames):
+            raise Exception(f"{self.numFrames} frames were written, but the Frames line says {self.declaredFrames} and can't be updated")
+
+def getBvhLineFormat(numChannels, decimals):
+    # BVH motion lines end every value with a space
+    return f"%.{decimals}f " * numChannels + "\n"
+
+def formatFrameBlock(frames, lineFormat):
+    # Formats a whole block of frames with a single %-formatting call
+    if(isinstance(frames, np.ndarray)):
+        values = frames.ravel().tolist()
+    else:
+        values = list(itertools.chain.from_iterable(frames))
+    return (lineFormat * len(frames)) % tuple(values)
+
+def writeFrameBlocks(f, motion, lineFormat, blockSize=4096):
+    for startFrame in range(0, motion.numFrames, blockSize):
+        f.write(formatFrameBlock(motion.getFrameSlice(startFrame, startFrame + blockSize), lineFormat))
+
+@profiled(frames=argumentFrames("bvhData"), bytesFrom="bvhPath")
+def writeBvh(bvhData, bvhPath, decimals = 6, compress = None):
+    with openTextFile(bvhPath, "w", compress) as f:
+        f.write("".join([line + "\n" for line in bvhData.header]))
         f.write("MOTION\n")
         f.write("Frames: " + str(bvhData.motion.numFrames) + "\n")
         f.write("Frame Time: " + str(bvhData.motion.frameTime) + "\n")
-        for frame in bvhData.motion.frames:
-            strings = [f"{x:.6f}" for x in frame]
-            for string in strings:
-                f.write(string + " ")
-            f.write("\n")
-
-def writeBvhToCsv(bvhData, csvPath, decimals = 6):
-    with open(csvPath, "w") as f:
+        numChannels = bvhData.skeleton.getLayout().numChannels
+        writeFrameBlocks(f, bvhData.motion, getBvhLineFormat(numChannels, decimals))
+
+@profiled(frames=argumentFrames("bvhData"), bytesFrom="csvPath")
+def writeBvhToCsv(bvhData, csvPath, decimals = 6, compress = None):
+    with openTextFile(csvPath, "w", compress) as f:
+        numChannels = 0
         for joint in bvhData.skeleton.joints:
             jointObject = bvhData.skeleton.getJoint(joint)
             jointClasses = [jointObject.name +  "_" + str(channel) for channel in jointObject.channels]
+            numChannels += len(jointClasses)
             if(len(jointClasses) > 0):
                 f.write(",".join(jointClasses) + ",")
         f.write("\n")
-        for frame in bvhData.motion.frames:
-            f.write(",".join([f"{x:.{decimals}f}" for x in frame]) + "\n")
-
-def writePositionsToCsv(bvhData, csvPath, decimals = 6):
-    with open(csvPath, "w") as f:
-        fkFrame = bvhData.getFKAtFrame(0)
-        f.write(",".join([str(x)+ "_x," + str(x)+"_y,"+ str(x)+"_z" for x in fkFrame.keys()]) + "\n")
-        for frameIndex in range(bvhData.motion.numFrames):
-            fkFrame = bvhData.getFKAtFrame(frameIndex)
-            points = [x[1] for x in fkFrame.values()]
-            f.write(",".join([f"{x[0]:.{decimals}f}, {x[1]:.{decimals}f}, {x[2]:.{decimals}f}" for x in points]) + "\n")
\ No newline at end of file
+        writeFrameBlocks(f, bvhData.motion, ",".join([f"%.{decimals}f"] * numChannels) + "\n")
+
+def iterPositionBlocks(bvhData, blockSize=16384, workers=1, chunkSize=None):
+    # Batched FK over blocks of frames, so only one block of rotation matrices is in memory at a time
+    for startFrame in range(0, bvhData.motion.numFrames, blockSize):
+        yield startFrame, bvhData.getFKAllFrames(slice(startFrame, startFrame + blockSize), workers=workers, chunkSize=chunkSize)[1]
+
+@profiled(frames=argumentFrames("bvhData"), bytesFrom="csvPath")
+def writePositionsToCsv(bvhData, csvPath, decimals = 6, compress = None, workers = 1, chunkSize = None):
+    with openTextFile(csvPath, "w", compress) as f:
+        f.write(",".join([str(x)+ "_x," + str(x)+"_y,"+ str(x)+"_z" for x in bvhData.skeleton.joints.keys()]) + "\n")
+        lineFormat = ",".join([f"%.{decimals}f, %.{decimals}f, %.{decimals}f"] * bvhData.skeleton.getLayout().numJoints) + "\n"
+        for _, blockPositions in iterPositionBlocks(bvhData, workers=workers, chunkSize=chunkSize):
+            for startFrame in range(0, len(blockPositions), 4096):
+                f.write(formatFrameBlock(blockPositions[startFrame:startFrame + 4096], lineFormat))
+
+POSITIONS_MAGIC = b"BVHPOSIT"
+POSITIONS_VERSION = 1
+
+def getPositionColumnNames(bvhData):
+    return [f"{jointName}_{axis}" for jointName in bvhData.skeleton.joints.keys() for axis in "xyz"]
+
+@profiled(frames=argumentFrames("bvhData"), bytesFrom="npyPath")
+def writePositionsToNpy(bvhData, npyPath, dtype=np.float64, workers=1, chunkSize=None):
+    # (frames, joints, 3) array in the joint order of bvhData.skeleton.joints, loadable with np.load(npyPath, mmap_mode="r")
+    shape = (bvhData.motion.numFrames, bvhData.skeleton.getLayout().numJoints, 3)
+    if(shape[0] == 0):
+        np.save(npyPath, np.zeros(shape, dtype=dtype))
+        return
+    positions = np.lib.format.open_memmap(npyPath, mode="w+", dtype=dtype, shape=shape)
+    for startFrame, blockPositions in iterPositionBlocks(bvhData, workers=workers, chunkSize=chunkSize):
+        positions[startFrame:startFrame + len(blockPositions)] = blockPositions
+    positions.flush()
+    del positions
+
+@profiled(frames=argumentFrames("bvhData"), bytesFrom="positionsPath")
+def writePositionsColumnar(bvhData, positionsPath, dtype=np.float32, workers=1, chunkSize=None):
+    # Column-major file: every "<joint>_<axis>" column is contiguous, described by a JSON header like the BVH cache
+    layout = bvhData.skeleton.getLayout()
+    numFrames = bvhData.motion.numFrames
+    columnNames = getPositionColumnNames(bvhData)
+    metadata = {
+        "version": POSITIONS_VERSION,
+        "columns": columnNames,
+        "joints": layout.jointNames,
+        "parents": layout.parents.tolist(),
+        "axes": ["x", "y", "z"],
+        "numFrames": numFrames,
+        "frameTime": bvhData.motion.frameTime,
+        "dtype": np.dtype(dtype).str,
+    }
+    with open(positionsPath, "wb") as f:
+        dataOffset = writeBinaryHeader(f, POSITIONS_MAGIC, metadata)
+        f.truncate(dataOffset + len(columnNames) * numFrames * np.dtype(dtype).itemsize)
+    if(numFrames == 0):
+        return
+    columns = np.memmap(positionsPath, dtype=dtype, mode="r+", offset=dataOffset, shape=(len(columnNames), numFrames))
+    for startFrame, blockPositions in iterPositionBlocks(bvhData, workers=workers, chunkSize=chunkSize):
+        columns[:, startFrame:startFrame + len(blockPositions)] = blockPositions.reshape(len(blockPositions), -1).T
+    columns.flush()
+    del columns
+
+def readPositionsColumnar(positionsPath, useMmap=True):
+    # Returns the metadata and a (columns, frames) array. With useMmap, columns are only read from disk when used.
+    metadata = readBinaryHeader(positionsPath, POSITIONS_MAGIC, "BVH positions")
+    if(metadata["version"] != POSITIONS_VERSION):
+        raise Exception(f"Unsupported BVH positions version {metadata['version']} in {positionsPath}")
+    shape = (len(metadata["columns"]), metadata["numFrames"])
+    if(useMmap and shape[0] * shape[1] > 0):
+        columns = np.memmap(positionsPath, dtype=metadata["dtype"], mode="r", offset=metadata["dataOffset"], shape=shape)
+    else:
+        with open(positionsPath, "rb") as f:
+            f.seek(metadata["dataOffset"])
+            columns = np.fromfile(f, dtype=metadata["dtype"], count=shape[0] * shape[1]).reshape(shape)
+    return metadata, columns
@@ -1,107 +1,117 @@
-import copy
+import numpy as np
 from scipy.spatial.transform import Rotation as R
+from bvhTools.bvhProfiler import profiled, argumentFrames
 
-def centerSkeletonRoot(bvhData, fkFrame=0):
-    bvhDataCopy = copy.deepcopy(bvhData)
+def getWorkingCopy(bvhData, inplace):
+    return bvhData if inplace else bvhData.copy()
+
+def getRootPositionColumns(bvhData):
+    layout = bvhData.skeleton.getLayout()
+    if(not layout.hasPosition[0]):
+        raise Exception(f"The root joint ({bvhData.skeleton.root.name}) has no position channels")
+    return layout.positionColumns[0]
+
+def offsetRootPosition(motion, rootColumns, offsets):
+    # Column-wise update, vectorized when the motion is stored as an array
+    for column, offset in zip(rootColumns, offsets):
+        motion.setValues(column, np.add(motion.getValues(column), offset))
+
+@profiled(frames=argumentFrames("bvhData"))
+def centerSkeletonRoot(bvhData, fkFrame=0, inplace=False):
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
     frame = bvhDataCopy.motion.getFrame(fkFrame)
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    offsets = [-float(frame[rootIndex]), -float(frame[rootIndex + 1]), -float(frame[rootIndex + 2])]
-    for frame in bvhDataCopy.motion.frames:
-        frame[rootIndex] += offsets[0]
-        frame[rootIndex+1] += offsets[1]
-        frame[rootIndex+2] += offsets[2]
+    rootColumns = getRootPositionColumns(bvhDataCopy)
+    offsets = [-float(frame[rootColumns[0]]), -float(frame[rootColumns[1]]), -float(frame[rootColumns[2]])]
+    offsetRootPosition(bvhDataCopy.motion, rootColumns, offsets)
 
     return bvhDataCopy
 
-def centerSkeletonFeet(bvhData, leftFootName = "LeftFoot", rightFootName = "RightFoot", fkFrame=0):
-    bvhDataCopy = copy.deepcopy(bvhData)
+@profiled(frames=argumentFrames("bvhData"))
+def centerSkeletonFeet(bvhData, leftFootName = "LeftFoot", rightFootName = "RightFoot", fkFrame=0, inplace=False):
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
     if(leftFootName not in bvhDataCopy.skeleton.joints):
         raise Exception(f"Left foot name ({leftFootName}) not found in skeleton")
     if(rightFootName not in bvhDataCopy.skeleton.joints):
         raise Exception(f"Right foot name ({rightFootName}) not found in skeleton")
-    avgFootHeight = (bvhDataCopy.getFKAtFrame(fkFrame)[leftFootName][1][1] + bvhDataCopy.getFKAtFrame(fkFrame)[rightFootName][1][1]) / 2
-    avgRootHeight = bvhDataCopy.getFKAtFrame(fkFrame)[bvhDataCopy.skeleton.root.name][1][1]
+    forwardFrame = bvhDataCopy.getFKAtFrame(fkFrame)
+    avgFootHeight = (forwardFrame[leftFootName][1][1] + forwardFrame[rightFootName][1][1]) / 2
+    avgRootHeight = forwardFrame[bvhDataCopy.skeleton.root.name][1][1]
     frame = bvhDataCopy.motion.getFrame(fkFrame)
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    offsets = [-float(frame[rootIndex]), -float(frame[rootIndex + 1]) + (avgRootHeight - avgFootHeight), -float(frame[rootIndex + 2])]
-    for frame in bvhDataCopy.motion.frames:
-        frame[rootIndex] += offsets[0]
-        frame[rootIndex+1] += offsets[1]
-        frame[rootIndex+2] += offsets[2]
+    rootColumns = getRootPositionColumns(bvhDataCopy)
+    offsets = [-float(frame[rootColumns[0]]), -float(frame[rootColumns[1]]) + (avgRootHeight - avgFootHeight), -float(frame[rootColumns[2]])]
+    offsetRootPosition(bvhDataCopy.motion, rootColumns, offsets)
 
     return bvhDataCopy
 
-def centerSkeletonXZ(bvhData, fkFrame=0):
-    bvhDataCopy = copy.deepcopy(bvhData)
+@profiled(frames=argumentFrames("bvhData"))
+def centerSkeletonXZ(bvhData, fkFrame=0, inplace=False):
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
     frame = bvhDataCopy.motion.getFrame(fkFrame)
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    offsets = [-float(frame[rootIndex]), -float(frame[rootIndex + 1]), -float(frame[rootIndex + 2])]
-    for frame in bvhDataCopy.motion.frames:
-        frame[rootIndex] += offsets[0]
-        frame[rootIndex+2] += offsets[2]
+    rootColumns = getRootPositionColumns(bvhDataCopy)
+    offsets = [-float(frame[rootColumns[0]]), -float(frame[rootColumns[1]]), -float(frame[rootColumns[2]])]
+    offsetRootPosition(bvhDataCopy.motion, rootColumns, [offsets[0], 0.0, offsets[2]])
 
     return bvhDataCopy
 
-def centerSkeletonAroundJoint(bvhData, jointName, fkFrame=0):
-    bvhDataCopy = copy.deepcopy(bvhData)
+@profiled(frames=argumentFrames("bvhData"))
+def centerSkeletonAroundJoint(bvhData, jointName, fkFrame=0, inplace=False):
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
     if(jointName not in bvhDataCopy.skeleton.joints):
         raise Exception(f"Selected joint ({jointName}) not found in skeleton")
     
     forwardFrame = bvhDataCopy.getFKAtFrame(fkFrame)
     frame = bvhDataCopy.motion.getFrame(fkFrame)
     jointOffsets = forwardFrame[jointName][1] - forwardFrame[bvhDataCopy.skeleton.root.name][1]
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    offsets = [-float(frame[rootIndex]) - jointOffsets[0], -float(frame[rootIndex + 1]) - jointOffsets[1], -float(frame[rootIndex + 2]) - jointOffsets[2]]
-    for frame in bvhDataCopy.motion.frames:
-        frame[rootIndex] += offsets[0]
-        frame[rootIndex+1] += offsets[1]
-        frame[rootIndex+2] += offsets[2]
+    rootColumns = getRootPositionColumns(bvhDataCopy)
+    offsets = [-float(frame[rootColumns[0]]) - jointOffsets[0], -float(frame[rootColumns[1]]) - jointOffsets[1], -float(frame[rootColumns[2]]) - jointOffsets[2]]
+    offsetRootPosition(bvhDataCopy.motion, rootColumns, offsets)
 
     return bvhDataCopy
 
-def rotateSkeletonLocal(bvhData, angle, fkFrame=0):
+def rotateRoot(bvhData, rotation, originPoint=None):
+    # Rotates the root of every frame at once: positions around originPoint, orientations pre-multiplied by the rotation
+    layout = bvhData.skeleton.getLayout()
+    if(not layout.hasRotation[0]):
+        raise Exception(f"The root joint ({bvhData.skeleton.root.name}) has no rotation channels")
+    rootColumns = list(getRootPositionColumns(bvhData))
+    rotationColumns = list(layout.rotationColumns[0])
+    rootChannelOrder = layout.rotationOrders[0]
+    rootPositions = np.asarray(bvhData.motion.getValues(rootColumns), dtype=np.float64).reshape(-1, 3)
+    if(originPoint is None):
+        originPoint = np.zeros(3)
+    newPositions = rotation.apply(rootPositions - originPoint) + originPoint
+    baseRotations = R.from_euler(rootChannelOrder, np.asarray(bvhData.motion.getValues(rotationColumns), dtype=np.float64).reshape(-1, 3), degrees=True)
+    newRotations = (rotation * baseRotations).as_euler(rootChannelOrder, degrees=True)
+    bvhData.motion.setValues(rootColumns, newPositions)
+    bvhData.motion.setValues(rotationColumns, newRotations)
+
+@profiled(frames=argumentFrames("bvhData"))
+def rotateSkeletonLocal(bvhData, angle, fkFrame=0, inplace=False):
     if(len(angle) != 3):
         raise Exception("angle must be a list of length 3")
-    bvhDataCopy = copy.deepcopy(bvhData)
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
     rotation = R.from_euler('XYZ', [angle[0], angle[1], angle[2]], degrees=True)
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    originPoint = bvhDataCopy.getFKAtFrame(fkFrame)[bvhDataCopy.skeleton.root.name][1]
-    rootChannelOrder = bvhData.skeleton.root.getRotationChannelsOrder()
-    for frameIndex, frame in enumerate(bvhDataCopy.motion.frames):
-        fkFrameRootPos = bvhDataCopy.getFKAtFrame(frameIndex)[bvhDataCopy.skeleton.root.name][1]
-        newPos = [x - y for x,y in zip(fkFrameRootPos, originPoint)]
-        newPos = rotation.apply(newPos)
-        newPos = [x + y for x,y in zip(newPos, originPoint)]
-        baseRotation = R.from_euler(rootChannelOrder, frame[rootIndex+3:rootIndex+6], degrees=True)
-        newRotation = rotation * baseRotation
-        frame[rootIndex:rootIndex+3] = newPos
-        frame[rootIndex+3:rootIndex+6] = newRotation.as_euler(rootChannelOrder, degrees=True)
+    # The root FK position is the value of its position channels
+    frame = bvhDataCopy.motion.getFrame(fkFrame)
+    originPoint = np.array([frame[column] for column in getRootPositionColumns(bvhDataCopy)], dtype=np.float64)
+    rotateRoot(bvhDataCopy, rotation, originPoint)
     return bvhDataCopy
 
-def rotateSkeletonWorld(bvhData, angle):
+@profiled(frames=argumentFrames("bvhData"))
+def rotateSkeletonWorld(bvhData, angle, inplace=False):
     if(len(angle) != 3):
         raise Exception("angle must be a list of length 3")
-    bvhDataCopy = copy.deepcopy(bvhData)
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
     rotation = R.from_euler('XYZ', [angle[0], angle[1], angle[2]], degrees=True)
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    rootChannelOrder = bvhData.skeleton.root.getRotationChannelsOrder()
-    for frameIndex, frame in enumerate(bvhDataCopy.motion.frames):
-        fkFrameRootPos = bvhDataCopy.getFKAtFrame(frameIndex)[bvhDataCopy.skeleton.root.name][1]
-        newPos = rotation.apply(fkFrameRootPos)
-        baseRotation = R.from_euler(rootChannelOrder, frame[rootIndex+3:rootIndex+6], degrees=True)
-        newRotation = rotation * baseRotation
-        frame[rootIndex:rootIndex+3] = newPos
-        frame[rootIndex+3:rootIndex+6] = newRotation.as_euler(rootChannelOrder, degrees=True)
+    rotateRoot(bvhDataCopy, rotation)
     return bvhDataCopy
 
-def moveSkeleton(bvhData, offsets):
+@profiled(frames=argumentFrames("bvhData"))
+def moveSkeleton(bvhData, offsets, inplace=False):
     if(len(offsets) != 3):
         raise Exception("offsets must be a list of length 3")
-    bvhDataCopy = copy.deepcopy(bvhData)
-    rootIndex = bvhDataCopy.skeleton.getJointIndex(bvhDataCopy.skeleton.root.name)
-    for frame in bvhDataCopy.motion.frames:
-        frame[rootIndex] += offsets[0]
-        frame[rootIndex+1] += offsets[1]
-        frame[rootIndex+2] += offsets[2]
+    bvhDataCopy = getWorkingCopy(bvhData, inplace)
+    rootColumns = getRootPositionColumns(bvhDataCopy)
+    offsetRootPosition(bvhDataCopy.motion, rootColumns, offsets)
 
     return bvhDataCopy
\ No newline at end of file
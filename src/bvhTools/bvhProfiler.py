@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+import contextlib
+
+# Active profiler, or None. The decorated functions only check this global when profiling is disabled.
+PROFILER = None
+
+class Profiler:
+    def __init__(self, recordCalls=False):
+        self.stats = {}
+        self.calls = []
+        self.recordCalls = recordCalls
+        self.lock = threading.Lock()
+
+    def record(self, name, startTime, elapsed, frames=0, numBytes=0):
+        with self.lock:
+            if(name not in self.stats):
+                self.stats[name] = {"calls": 0, "totalTime": 0.0, "maxTime": 0.0, "frames": 0, "bytes": 0}
+            functionStats = self.stats[name]
+            functionStats["calls"] += 1
+            functionStats["totalTime"] += elapsed
+            functionStats["maxTime"] = max(functionStats["maxTime"], elapsed)
+            functionStats["frames"] += frames
+            functionStats["bytes"] += numBytes
+            if(self.recordCalls):
+                self.calls.append({"name": name, "start": startTime, "time": elapsed, "frames": frames, "bytes": numBytes})
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.calls = []
+
+    def getStats(self):
+        # Times are inclusive: a function that calls another profiled function also counts the time spent in it
+        with self.lock:
+            return {name: dict(functionStats) for name, functionStats in self.stats.items()}
+
+    def getCalls(self):
+        with self.lock:
+            return list(self.calls)
+
+    def toJsonLines(self):
+        # One line per function, or one line per call if the calls are recorded
+        if(self.recordCalls):
+            return "".join(json.dumps(call) + "\n" for call in self.getCalls())
+        return "".join(json.dumps({"name": name, **functionStats}) + "\n" for name, functionStats in self.getStats().items())
+
+    def writeJsonLines(self, path):
+        with open(path, "w") as f:
+            f.write(self.toJsonLines())
+
+    def printStats(self):
+        stats = sorted(self.getStats().items(), key=lambda item: item[1]["totalTime"], reverse=True)
+        print(f"{'function':<48} {'calls':>8} {'total (s)':>10} {'max (s)':>10} {'frames':>10} {'bytes':>12}")
+        for name, functionStats in stats:
+            print(f"{name:<48} {functionStats['calls']:>8} {functionStats['totalTime']:>10.4f} {functionStats['maxTime']:>10.4f} {functionStats['frames']:>10} {functionStats['bytes']:>12}")
+
+def enableProfiling(recordCalls=False):
+    global PROFILER
+    PROFILER = Profiler(recordCalls)
+    return PROFILER
+
+def disableProfiling():
+    global PROFILER
+    profiler = PROFILER
+    PROFILER = None
+    return profiler
+
+def getProfiler():
+    return PROFILER
+
+@contextlib.contextmanager
+def profiling(recordCalls=False):
+    global PROFILER
+    previousProfiler = PROFILER
+    profiler = enableProfiling(recordCalls)
+    try:
+        yield profiler
+    finally:
+        PROFILER = previousProfiler
+
+@contextlib.contextmanager
+def profileBlock(name, frames=0, numBytes=0):
+    # Times any block of code under the given name, if profiling is enabled
+    profiler = PROFILER
+    if(profiler is None):
+        yield
+        return
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(name, startTime, time.perf_counter() - startTime, frames, numBytes)
+
+def getFileSize(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+def profiled(frames=None, bytesFrom=None, name=None):
+    # frames: a number of frames per call, or a function(arguments, result) returning it, where arguments maps the parameter names to their values.
+    # bytesFrom: name of the path parameter whose file size is recorded (read after the call, so it also works for writers).
+    def decorator(function):
+        functionName = name or f"{function.__module__.split('.')[-1]}.{function.__qualname__}"
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = PROFILER
+            if(profiler is None):
+                return function(*args, **kwargs)
+            startTime = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - startTime
+            numFrames, numBytes = 0, 0
+            if(frames is not None or bytesFrom is not None):
+                arguments = signature.bind(*args, **kwargs).arguments
+                try:
+                    numFrames = frames(arguments, result) if callable(frames) else (frames or 0)
+                except Exception:
+                    numFrames = 0
+                if(bytesFrom is not None):
+                    numBytes = getFileSize(arguments.get(bytesFrom))
+            profiler.record(functionName, startTime, elapsed, numFrames, numBytes)
+            return result
+        return wrapper
+    return decorator
+
+def resultFrames(arguments, result):
+    return result.motion.numFrames
+
+def argumentFrames(argumentName):
+    return lambda arguments, result: arguments[argumentName].motion.numFrames
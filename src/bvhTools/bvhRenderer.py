@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import concurrent.futures
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+# Offscreen rendering with the Agg canvas directly (no pyplot, no window), so it works on machines without a display.
+# The playback helpers below are shared with the interactive viewer, which is the only module that imports pyplot.
+
+def getPlaybackPositions(bvhData, frames=None, blockSize=16384):
+    # Global positions of all frames (or only the given ones), in plotting axes (-X, Z, Y), computed with the batched FK one block at a time
+    layout = bvhData.skeleton.getLayout()
+    frameNumbers = np.arange(bvhData.motion.numFrames) if frames is None else np.asarray(frames, dtype=int)
+    positions = np.empty((len(frameNumbers), layout.numJoints, 3), dtype=np.float32)
+    for startFrame in range(0, len(frameNumbers), blockSize):
+        blockFrames = frameNumbers[startFrame:startFrame + blockSize]
+        # Consecutive frames are requested as a slice, so only that range of the motion is converted (or parsed, for lazy motions)
+        if(len(blockFrames) > 0 and np.all(np.diff(blockFrames) == 1)):
+            blockFrames = slice(int(blockFrames[0]), int(blockFrames[-1]) + 1)
+        blockPositions = bvhData.getFKAllFrames(blockFrames)[1]
+        positions[startFrame:startFrame + len(blockPositions)] = blockPositions[:, :, [0, 2, 1]] * np.array([-1, 1, 1])
+    return positions
+
+def getBoneSegments(positions, parents):
+    # (bones, 2, 3) segments from every joint to its parent
+    children = np.flatnonzero(parents >= 0)
+    return np.stack([positions[parents[children]], positions[children]], axis=1)
+
+def updateSkeletonArtists(scatter, bones, framePositions, parents):
+    # Blitting only calls draw_artist, which doesn't re-project 3D artists, so the new positions are projected here
+    scatter._offsets3d = (framePositions[:, 0], framePositions[:, 1], framePositions[:, 2])
+    bones.set_segments(getBoneSegments(framePositions, parents))
+    scatter.do_3d_projection()
+    bones.do_3d_projection()
+
+def createRenderFigure(firstPositions, parents, maxDim, width=640, height=480, dpi=100):
+    # The figure and its artists are created once per worker and then only updated for every frame
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection='3d')
+    quiverSize = 0.05 * maxDim
+    ax.set_xlim3d(-maxDim, maxDim)
+    ax.set_ylim3d(-maxDim, maxDim)
+    ax.set_zlim3d(-maxDim, maxDim)
+    ax.quiver(0, 0, 0, quiverSize, 0, 0, color='r')  # Red = X
+    ax.quiver(0, 0, 0, 0, quiverSize, 0, color='g')  # Green = Y
+    ax.quiver(0, 0, 0, 0, 0, quiverSize, color='b')  # Blue = Z
+    scatter = ax.scatter(firstPositions[:, 0], firstPositions[:, 1], firstPositions[:, 2], c="b", marker="o")
+    bones = Line3DCollection(getBoneSegments(firstPositions, parents), colors="b", linewidths=1.5)
+    ax.add_collection3d(bones)
+    frameLabel = ax.text2D(0.02, 0.98, "", transform=ax.transAxes, fontsize=10, verticalalignment="top")
+    return fig, (scatter, bones, frameLabel)
+
+def drawFrame(fig, artists, framePositions, parents, frameNumber):
+    scatter, bones, frameLabel = artists
+    scatter._offsets3d = (framePositions[:, 0], framePositions[:, 1], framePositions[:, 2])
+    bones.set_segments(getBoneSegments(framePositions, parents))
+    frameLabel.set_text(f"Frame: {frameNumber}")
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())
+
+def renderFrameRange(positions, parents, frameNumbers, imagePaths, maxDim, width, height, dpi):
+    # Runs in the worker processes. Only the positions of this range are sent, and only the paths are returned.
+    fig, artists = createRenderFigure(positions[0], parents, maxDim, width, height, dpi)
+    for framePositions, frameNumber, imagePath in zip(positions, frameNumbers, imagePaths):
+        # The drawn canvas is saved as it is, savefig would draw the whole figure again
+        imsave(imagePath, drawFrame(fig, artists, framePositions, parents, frameNumber))
+    return imagePaths
+
+def getRenderMaxDim(bvhData):
+    return float(np.max(np.abs(bvhData.getMotionDims())))
+
+def renderFrames(bvhData, outputDir, frames=None, step=1, workers=1, imageFormat="png", width=640, height=480, dpi=100, fileNamePattern="frame_{:06d}"):
+    # Writes one image per frame. The frames are split in contiguous ranges that are rendered in a pool of processes.
+    frameNumbers = np.arange(bvhData.motion.numFrames)[::step] if frames is None else np.asarray(list(frames), dtype=int)
+    if(len(frameNumbers) == 0):
+        return []
+    os.makedirs(outputDir, exist_ok=True)
+    positions = getPlaybackPositions(bvhData, frameNumbers)
+    parents = bvhData.skeleton.getLayout().parents
+    maxDim = getRenderMaxDim(bvhData)
+    # Images are numbered by their position in the sequence, so they can be read back directly as a video
+    imagePaths = [os.path.join(outputDir, fileNamePattern.format(imageIndex) + "." + imageFormat) for imageIndex in range(len(frameNumbers))]
+
+    workers = workers or os.cpu_count() or 1
+    if(workers == 1 or len(frameNumbers) < 2 * workers):
+        return renderFrameRange(positions, parents, frameNumbers, imagePaths, maxDim, width, height, dpi)
+    ranges = np.array_split(np.arange(len(frameNumbers)), workers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(renderFrameRange, positions[indexes], parents, frameNumbers[indexes], [imagePaths[i] for i in indexes], maxDim, width, height, dpi) for indexes in ranges]
+        for future in futures:
+            future.result()
+    return imagePaths
+
+def renderThumbnail(bvhData, imagePath, frame=0, width=320, height=240, dpi=100):
+    renderFrameRange(getPlaybackPositions(bvhData, [frame]), bvhData.skeleton.getLayout().parents, [frame], [imagePath], getRenderMaxDim(bvhData), width, height, dpi)
+
+def renderVideo(bvhData, videoPath, fps=None, frames=None, step=1, workers=1, width=640, height=480, dpi=100):
+    # The frames are rendered (in parallel) to a temporary image sequence, then encoded: .gif with Pillow, anything else with ffmpeg
+    if(fps is None):
+        fps = 1 / (bvhData.motion.frameTime * step) if bvhData.motion.frameTime > 0 else 30
+    isGif = str(videoPath).lower().endswith(".gif")
+    if(not isGif and shutil.which("ffmpeg") is None):
+        raise Exception(f"ffmpeg was not found, it is needed to write {videoPath}. Use a .gif path or renderFrames instead.")
+    with tempfile.TemporaryDirectory() as frameDir:
+        imagePaths = renderFrames(bvhData, frameDir, frames, step, workers, "png", width, height, dpi)
+        if(len(imagePaths) == 0):
+            raise Exception("There are no frames to render")
+        if(isGif):
+            from PIL import Image
+            images = []
+            for imagePath in imagePaths:
+                with Image.open(imagePath) as image:
+                    images.append(image.convert("RGB"))
+            images[0].save(videoPath, save_all=True, append_images=images[1:], duration=1000 / fps, loop=0)
+        else:
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-framerate", str(fps), "-i", os.path.join(frameDir, "frame_%06d.png"),
+                       "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", str(videoPath)]
+            subprocess.run(command, check=True)
+    return videoPath
@@ -0,0 +1,84 @@
+import numpy as np
+from bvhTools.bvhDataTypes import MotionData, eulerToQuaternions, quaternionsToEuler, getClosestEulerAngles
+from bvhTools.bvhProfiler import profiled, argumentFrames
+
+def slerpQuaternions(q0, q1, weights):
+    # Spherical interpolation of (..., 4) quaternions, with (...) weights from 0 (q0) to 1 (q1)
+    dots = np.sum(q0 * q1, axis=-1)
+    # q and -q are the same rotation, so the shortest path is taken
+    q1 = np.where((dots < 0)[..., None], -q1, q1)
+    dots = np.abs(dots)
+    angles = np.arccos(np.clip(dots, -1.0, 1.0))
+    sines = np.sin(angles)
+    # Almost equal quaternions are interpolated linearly, to avoid dividing by ~0
+    linear = sines < 1e-6
+    safeSines = np.where(linear, 1.0, sines)
+    weights0 = np.where(linear, 1.0 - weights, np.sin((1.0 - weights) * angles) / safeSines)
+    weights1 = np.where(linear, weights, np.sin(weights * angles) / safeSines)
+    quaternions = weights0[..., None] * q0 + weights1[..., None] * q1
+    return quaternions / np.linalg.norm(quaternions, axis=-1, keepdims=True)
+
+def getResampleTimes(numFrames, frameTime, newFrameTime):
+    # Source frame (as a float) of every new frame, covering the same duration as the original clip
+    duration = (numFrames - 1) * frameTime
+    numNewFrames = int(np.floor(duration / newFrameTime + 1e-9)) + 1
+    sourceFrames = np.minimum(np.arange(numNewFrames) * (newFrameTime / frameTime), numFrames - 1)
+    # Rounding errors are removed, so new frames that fall on a source frame are detected as such
+    roundedFrames = np.round(sourceFrames)
+    return np.where(np.abs(sourceFrames - roundedFrames) < 1e-6, roundedFrames, sourceFrames)
+
+def resampleFrames(layout, frameArray, sourceFrames):
+    previousFrames = np.floor(sourceFrames).astype(int)
+    weights = sourceFrames - previousFrames
+    # New frames that fall on a source frame are copied as they are, only the rest are interpolated
+    newFrames = frameArray[previousFrames].astype(np.float64)
+    between = np.flatnonzero(weights > 0)
+    if(len(between) == 0):
+        return newFrames
+    previousFrames, weights = previousFrames[between], weights[between]
+    nextFrames = previousFrames + 1
+    # Every source frame needed by the block is converted once, even if several new frames use it
+    usedFrames = np.unique(np.concatenate([previousFrames, nextFrames]))
+    previousRows = np.searchsorted(usedFrames, previousFrames)
+    nextRows = np.searchsorted(usedFrames, nextFrames)
+    usedArray = frameArray[usedFrames].astype(np.float64)
+
+    # All the channels are interpolated linearly, then the rotations of the joints with three rotation channels are replaced by their SLERP
+    previousArray = usedArray[previousRows]
+    betweenFrames = previousArray * (1.0 - weights[:, None]) + usedArray[nextRows] * weights[:, None]
+    for rotOrder, (_, groupColumns) in layout.rotationGroups.items():
+        quaternions = eulerToQuaternions(rotOrder, usedArray[:, groupColumns])
+        newAngles = quaternionsToEuler(rotOrder, slerpQuaternions(quaternions[previousRows], quaternions[nextRows], weights[:, None]))
+        betweenFrames[:, groupColumns] = getClosestEulerAngles(newAngles, previousArray[:, groupColumns])
+    newFrames[between] = betweenFrames
+    return newFrames
+
+@profiled(frames=argumentFrames("bvhData"))
+def resampleBvh(bvhData, frameTime=None, fps=None, chunkSize=2048):
+    # Returns a new BVH with the motion resampled to the given frame time (or fps). The original is not modified.
+    if((frameTime is None) == (fps is None)):
+        raise Exception("Provide either a frameTime or an fps to resample to")
+    newFrameTime = frameTime if frameTime is not None else 1.0 / fps
+    if(newFrameTime <= 0):
+        raise Exception(f"The new frame time must be positive ({newFrameTime})")
+    motion = bvhData.motion
+    if(motion.frameTime <= 0):
+        raise Exception("The motion has no valid frame time to resample from")
+
+    if(motion.numFrames < 2):
+        resampledMotion = motion.copy()
+        resampledMotion.frameTime = newFrameTime
+    else:
+        layout = bvhData.skeleton.getLayout()
+        frameArray = motion.getFramesArray()
+        sourceFrames = getResampleTimes(motion.numFrames, motion.frameTime, newFrameTime)
+        # The new frames are computed in blocks, so the temporary quaternions of long clips fit in memory
+        newFrames = np.empty((len(sourceFrames), frameArray.shape[1]), dtype=frameArray.dtype if motion.isArray() else np.float64)
+        for startFrame in range(0, len(sourceFrames), chunkSize):
+            endFrame = min(startFrame + chunkSize, len(sourceFrames))
+            newFrames[startFrame:endFrame] = resampleFrames(layout, frameArray, sourceFrames[startFrame:endFrame])
+        resampledMotion = MotionData(len(newFrames), newFrameTime, newFrames if motion.isArray() else newFrames.tolist())
+
+    resampledBvh = bvhData.copy(resampledMotion)
+    resampledBvh.inheritSkeletonDims(bvhData)
+    return resampledBvh
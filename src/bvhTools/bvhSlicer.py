@@ -1,10 +1,11 @@
-import copy
-from bvhTools.bvhDataTypes import BVHData, MotionData
+from bvhTools.bvhDataTypes import concatenateMotionData
 
 def getBvhSlice(bvhData, fromFrame, toFrame):
     if(fromFrame > toFrame):
         raise Exception("fromFrame must be less than toFrame")
-    slicedBvh = BVHData(bvhData.skeleton, MotionData(toFrame - fromFrame, bvhData.motion.frameTime, bvhData.motion.getFrameSlice(fromFrame, toFrame)), bvhData.header)
+    # The slice shares the skeleton and header, and its motion is a view of the original until one of them is modified
+    slicedBvh = bvhData.copy(bvhData.motion.getSlice(fromFrame, toFrame))
+    slicedBvh.inheritSkeletonDims(bvhData)
     return slicedBvh
 
 def getBvhSlices(bvhData, fromFrames, toFrames):
@@ -18,19 +19,11 @@ def getBvhSlices(bvhData, fromFrames, toFrames):
 def appendBvhSlices(baseBvh, bvhsToAppend):
     if(len(bvhsToAppend) == 0):
         raise Exception("You must provide at least one BVH to append")
-    bvhData = copy.deepcopy(baseBvh)
-    for bvh in bvhsToAppend:
-        for frame in bvh.motion.frames:
-            bvhData.motion.frames.append(frame)
-        bvhData.motion.numFrames += bvh.motion.numFrames
+    bvhData = baseBvh.copy(concatenateMotionData([baseBvh.motion] + [bvh.motion for bvh in bvhsToAppend]))
     return bvhData
         
 def groupBvhSlices(bvhsToGroup):
     if(len(bvhsToGroup) <= 1):
         raise Exception("You must provide at least two BVHs to append")
-    bvhData = copy.deepcopy(bvhsToGroup[0])
-    for bvh in bvhsToGroup[1:]:
-        for frame in bvh.motion.frames:
-            bvhData.motion.frames.append(frame)
-        bvhData.motion.numFrames += bvh.motion.numFrames
+    bvhData = bvhsToGroup[0].copy(concatenateMotionData([bvh.motion for bvh in bvhsToGroup]))
     return bvhData
\ No newline at end of file
@@ -1,13 +1,22 @@
+import time
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from matplotlib.widgets import Button, TextBox
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 import numpy as np
+from bvhTools.bvhRenderer import getPlaybackPositions, getBoneSegments, updateSkeletonArtists
 
-def showBvhAnimation(bvhData):
+def showBvhAnimation(bvhData, realTime=False):
+    if(realTime):
+        return showBvhAnimationRealTime(bvhData)
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
 
-    fig.canvas.manager.window.showMaximized()
+    # Only GUI backends (e.g. Qt) have a window to maximize
+    try:
+        fig.canvas.manager.window.showMaximized()
+    except AttributeError:
+        pass
 
     motionDims = bvhData.getMotionDims()
     maxDim = np.max(np.abs(motionDims))
@@ -108,4 +117,112 @@ def showBvhAnimation(bvhData):
 
     label = fig.text(0.475, 0.85, "Frame: 0", fontsize=12)
 
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+def showBvhAnimationRealTime(bvhData, speed=1.0):
+    # Playback that follows the wall clock: positions are precomputed once, the artists are updated in place and blitted,
+    # and frames are skipped when drawing can't keep up with frameTime.
+    positions = getPlaybackPositions(bvhData)
+    parents = bvhData.skeleton.getLayout().parents
+    numFrames = bvhData.motion.numFrames
+    frameTime = bvhData.motion.frameTime if bvhData.motion.frameTime > 0 else 1 / 30
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection='3d')
+    # Only GUI backends (e.g. Qt) have a window to maximize
+    try:
+        fig.canvas.manager.window.showMaximized()
+    except AttributeError:
+        pass
+
+    maxDim = np.max(np.abs(bvhData.getMotionDims()))
+    quiverSize = 0.05 * maxDim
+    ax.set_xlim3d(-maxDim, maxDim)
+    ax.set_ylim3d(-maxDim, maxDim)
+    ax.set_zlim3d(-maxDim, maxDim)
+    ax.quiver(0, 0, 0, quiverSize, 0, 0, color='r', label='X')  # Red = X
+    ax.quiver(0, 0, 0, 0, quiverSize, 0, color='g', label='Y')  # Green = Y
+    ax.quiver(0, 0, 0, 0, 0, quiverSize, color='b', label='Z')  # Blue = Z
+
+    scatter = ax.scatter(positions[0, :, 0], positions[0, :, 1], positions[0, :, 2], c="b", marker="o")
+    bones = Line3DCollection(getBoneSegments(positions[0], parents), colors="b", linewidths=1.5)
+    ax.add_collection3d(bones)
+    frameLabel = ax.text2D(0.02, 0.98, "", transform=ax.transAxes, fontsize=12, verticalalignment="top")
+    rateLabel = ax.text2D(0.02, 0.93, "", transform=ax.transAxes, fontsize=10, verticalalignment="top")
+
+    # Playback clock: the shown frame is anchorFrame plus the frames elapsed since anchorTime, scaled by the speed
+    state = {"anchorFrame": 0, "anchorTime": time.perf_counter(), "speed": speed, "paused": False, "frame": 0,
+             "lastDrawTime": None, "drawRate": 0.0, "droppedFrames": 0}
+
+    def reanchor(frame):
+        state["anchorFrame"] = frame % numFrames
+        state["anchorTime"] = time.perf_counter()
+        state["frame"] = state["anchorFrame"]
+
+    def update(_):
+        now = time.perf_counter()
+        previousFrame = state["frame"]
+        if(not state["paused"]):
+            elapsedFrames = int((now - state["anchorTime"]) * state["speed"] / frameTime)
+            state["frame"] = (state["anchorFrame"] + elapsedFrames) % numFrames
+            state["droppedFrames"] += max(0, (state["frame"] - previousFrame) % numFrames - 1)
+        if(state["lastDrawTime"] is not None and now > state["lastDrawTime"]):
+            state["drawRate"] = 0.9 * state["drawRate"] + 0.1 / (now - state["lastDrawTime"])
+        state["lastDrawTime"] = now
+
+        updateSkeletonArtists(scatter, bones, positions[state["frame"]], parents)
+        frameLabel.set_text(f"Frame: {state['frame']}")
+        rateLabel.set_text(f"{state['drawRate']:.0f} fps drawn / {state['speed'] / frameTime:.0f} fps target (x{state['speed']:g}), {state['droppedFrames']} dropped")
+        return scatter, bones, frameLabel, rateLabel
+
+    def togglePause(event):
+        state["paused"] = not state["paused"]
+        reanchor(state["frame"])
+        btnPlayPause.label.set_text("Play" if state["paused"] else "Pause")
+        textbox.set_val(str(state["frame"]))
+
+    def step(frameIncrement):
+        state["paused"] = True
+        btnPlayPause.label.set_text("Play")
+        reanchor(state["frame"] + frameIncrement)
+        textbox.set_val(str(state["frame"]))
+
+    def changeSpeed(factor):
+        reanchor(state["frame"])
+        state["speed"] *= factor
+
+    def goToFrame(text):
+        try:
+            reanchor(min(max(int(text), 0), numFrames - 1))
+        except ValueError:
+            pass
+
+    # The timer ticks at the frame rate (capped by how fast matplotlib can draw); the shown frame always comes from the clock
+    anim = animation.FuncAnimation(fig, update, interval=max(1, frameTime * 1000), blit=True, cache_frame_data=False)
+
+    axBtnPlayPause = plt.axes([0.45, 0.05, 0.1, 0.05])
+    btnPlayPause = Button(axBtnPlayPause, "Pause")
+    btnPlayPause.on_clicked(togglePause)
+
+    axBtnBack = plt.axes([0.34, 0.05, 0.1, 0.05])
+    btnBack = Button(axBtnBack, "Back")
+    btnBack.on_clicked(lambda event: step(-1))
+
+    axBtnForward = plt.axes([0.56, 0.05, 0.1, 0.05])
+    btnForward = Button(axBtnForward, "Forward")
+    btnForward.on_clicked(lambda event: step(1))
+
+    axBtnFaster = plt.axes([0.395, 0.9, 0.1, 0.05])
+    btnFaster = Button(axBtnFaster, "Faster")
+    btnFaster.on_clicked(lambda event: changeSpeed(2))
+
+    axBtnSlower = plt.axes([0.505, 0.9, 0.1, 0.05])
+    btnSlower = Button(axBtnSlower, "Slower")
+    btnSlower.on_clicked(lambda event: changeSpeed(0.5))
+
+    ax_textbox = plt.axes([0.8, 0.9, 0.1, 0.05])  # [x, y, width, height]
+    textbox = TextBox(ax_textbox, "Go to frame: ")
+    textbox.on_submit(goToFrame)
+
+    plt.show()
+    return anim
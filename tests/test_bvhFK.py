@@ -0,0 +1,24 @@
+import os
+import numpy as np
+import pytest
+from bvhTools.bvhIO import readBvh
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testBvhFiles")
+READ_OPTIONS = {"list": {}, "array": {"dtype": np.float64}, "lazy": {"lazy": True}}
+
+@pytest.mark.parametrize("fileName", ["test2", "test3"])
+@pytest.mark.parametrize("readMode", list(READ_OPTIONS))
+def test_batchedFKMatchesPerFrameFK(fileName, readMode):
+    # test3 has position channels on non-root joints and different rotation orders
+    bvhData = readBvh(os.path.join(TEST_FILES_DIR, fileName + ".bvh"), **READ_OPTIONS[readMode])
+    frames = np.unique(np.linspace(0, bvhData.motion.numFrames - 1, 25).astype(int))
+    jointNames = list(bvhData.skeleton.joints.keys())
+    for frameSelection in [frames, None]:
+        globalRots, globalPos = bvhData.getFKAllFrames(frameSelection)
+        for row, frame in enumerate(frames):
+            fkFrame = bvhData.getFKAtFrame(int(frame))
+            expectedRots = np.array([fkFrame[jointName][0] for jointName in jointNames])
+            expectedPos = np.array([fkFrame[jointName][1] for jointName in jointNames])
+            resultRow = row if frameSelection is not None else frame
+            assert np.allclose(globalRots[resultRow], expectedRots, rtol=0, atol=1e-9)
+            assert np.allclose(globalPos[resultRow], expectedPos, rtol=0, atol=1e-9)
@@ -0,0 +1,26 @@
+import os
+import pathlib
+import numpy as np
+import pytest
+from bvhTools.bvhIO import readBvh
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testBvhFiles")
+
+def addBlankLines(text, blankLine):
+    # Blank lines in the middle and at the end of the motion section
+    lines = text.rstrip("\n").split("\n")
+    firstFrameLine = lines.index("MOTION") + 3
+    lines = lines[:firstFrameLine + 10] + [blankLine, ""] + lines[firstFrameLine + 10:] + [blankLine]
+    return "\n".join(lines) + "\n"
+
+@pytest.mark.parametrize("blankLine", ["", "   ", "\t \t", " \r"])
+def test_lazyMatchesEager(tmp_path, blankLine):
+    with open(os.path.join(TEST_FILES_DIR, "test2.bvh"), "r") as f:
+        text = f.read()
+    bvhPath = pathlib.Path(tmp_path) / "blankLines.bvh"
+    bvhPath.write_text(addBlankLines(text, blankLine))
+    eagerBvh = readBvh(bvhPath, dtype=np.float64)
+    lazyBvh = readBvh(bvhPath, lazy=True)
+    assert lazyBvh.motion.numFrames == eagerBvh.motion.numFrames
+    assert np.array_equal(lazyBvh.motion.getFrame(-1), eagerBvh.motion.frames[-1])
+    assert np.array_equal(lazyBvh.motion.getFrameSlice(0, lazyBvh.motion.numFrames), eagerBvh.motion.frames)
@@ -0,0 +1,115 @@
+import os
+import json
+import random
+import numpy as np
+import pytest
+from bvhTools.bvhIO import readBvh, buildSkeleton, parseHierarchy
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testBvhFiles")
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+TEST_FILES = ["test2", "test3"]
+
+def readHeader(fileName):
+    with open(os.path.join(TEST_FILES_DIR, fileName + ".bvh"), "r") as f:
+        lines = f.read().splitlines()
+    return lines[:lines.index("MOTION")]
+
+def readMotionText(fileName):
+    with open(os.path.join(TEST_FILES_DIR, fileName + ".bvh"), "r") as f:
+        lines = f.read().splitlines()
+    return lines[lines.index("MOTION"):]
+
+def getJointList(skeleton):
+    return [{"name": joint.name, "parent": None if joint.parent is None else joint.parent.name, "offset": joint.offset.tolist(), "channels": list(joint.channels)} for joint in skeleton.iterJoints(skeleton.root)]
+
+def getHeaderOffsets(header):
+    # Offsets written in a header, in depth-first order, read with the parser itself
+    return [joint["offset"] for joint in getJointList(buildSkeleton(header, warn=False))]
+
+def writeBvhText(path, header, motionLines):
+    with open(path, "w") as f:
+        f.write("\n".join(header + motionLines) + "\n")
+
+@pytest.mark.parametrize("fileName", TEST_FILES)
+def test_matchesOldParser(fileName):
+    # Reference output of the recursive parser that was replaced by parseHierarchy
+    with open(os.path.join(DATA_DIR, fileName + "Hierarchy.json"), "r") as f:
+        expected = json.load(f)
+    bvhData = readBvh(os.path.join(TEST_FILES_DIR, fileName + ".bvh"))
+    assert getJointList(bvhData.skeleton) == expected["joints"]
+    assert bvhData.motion.numFrames == expected["numFrames"]
+    assert bvhData.motion.frameTime == expected["frameTime"]
+
+@pytest.mark.parametrize("fileName", TEST_FILES)
+@pytest.mark.parametrize("seed", range(20))
+def test_whitespaceReformatting(fileName, seed):
+    # Any whitespace between the tokens (tabs, spaces, line breaks, braces on the same line) gives the same skeleton
+    header = readHeader(fileName)
+    expected = getJointList(buildSkeleton(header, warn=False))
+    generator = random.Random(seed)
+    tokens = " ".join(header).split()
+    text = tokens[0]
+    for token in tokens[1:]:
+        text += generator.choice([" ", "  ", "\t", "\n", " \t ", "\n\t\t", "\r\n"]) + token
+    reformattedHeader = [line.rstrip("\r") for line in text.split("\n")]
+    assert getJointList(buildSkeleton(reformattedHeader, warn=False)) == expected
+
+@pytest.mark.parametrize("fileName", TEST_FILES)
+@pytest.mark.parametrize("seed", range(50))
+def test_tokenCorruption(fileName, seed):
+    # Deleting, duplicating or replacing tokens either still parses or raises a plain Exception, never an internal error
+    generator = random.Random(seed)
+    tokens = " ".join(readHeader(fileName)).split()
+    for _ in range(generator.randint(1, 5)):
+        position = generator.randrange(len(tokens))
+        action = generator.choice(["delete", "duplicate", "replace"])
+        if(action == "delete"):
+            del tokens[position]
+        elif(action == "duplicate"):
+            tokens.insert(position, tokens[position])
+        else:
+            tokens[position] = generator.choice(["{", "}", "OFFSET", "CHANNELS", "JOINT", "End", "Site", "ROOT", "abc", "-1", "3", "1e400", "nan"])
+    try:
+        parseHierarchy([" ".join(tokens)])
+    except Exception as error:
+        assert type(error) is Exception
+
+def test_deepChain(tmp_path):
+    # A long chain of joints is parsed without recursion, and its batched FK adds up all the offsets
+    depth = 3000
+    header = ["HIERARCHY", "ROOT Joint0", "{", "OFFSET 0 0 0", "CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation"]
+    for jointIndex in range(1, depth):
+        header += [f"JOINT Joint{jointIndex}", "{", "OFFSET 0 1 0", "CHANNELS 3 Zrotation Xrotation Yrotation"]
+    header += ["End Site", "{", "OFFSET 0 1 0", "}"] + ["}"] * depth
+    numChannels = 6 + 3 * (depth - 1)
+    bvhPath = tmp_path / "deepChain.bvh"
+    writeBvhText(bvhPath, header, ["MOTION", "Frames: 2", "Frame Time: 0.033333"] + [" ".join(["0"] * numChannels)] * 2)
+    bvhData = readBvh(bvhPath, dtype=np.float64)
+    assert len(bvhData.skeleton.joints) == depth + 1
+    positions = bvhData.getFKAllFrames()[1]
+    assert np.allclose(positions[:, -1], [0, depth, 0])
+
+@pytest.mark.parametrize("fileName", TEST_FILES)
+def test_restPoseWithOffsetOnBraceLine(tmp_path, fileName):
+    # The header offsets written by setRestPose do not depend on where the braces are
+    header = readHeader(fileName)
+    braceHeader = []
+    for line in header:
+        if(line.strip() == "{"):
+            continue
+        if(line.strip().startswith("OFFSET")):
+            line = line.replace("OFFSET", "{ OFFSET", 1)
+        braceHeader.append(line)
+    bvhPath = tmp_path / (fileName + "Braces.bvh")
+    writeBvhText(bvhPath, braceHeader, readMotionText(fileName))
+
+    bvhData = readBvh(os.path.join(TEST_FILES_DIR, fileName + ".bvh"))
+    braceBvhData = readBvh(bvhPath)
+    assert getJointList(braceBvhData.skeleton) == getJointList(bvhData.skeleton)
+    jointName = bvhData.skeleton.root.children[0].children[0].name
+    bvhData.setRestPose({jointName: [0, 0, 30]})
+    braceBvhData.setRestPose({jointName: [0, 0, 30]})
+
+    expectedOffsets = [joint.offset.tolist() for joint in braceBvhData.skeleton.iterJoints(braceBvhData.skeleton.root)]
+    assert np.allclose(getHeaderOffsets(braceBvhData.header), expectedOffsets, atol=1e-6)
+    assert np.allclose(getHeaderOffsets(braceBvhData.header), getHeaderOffsets(bvhData.header))
@@ -0,0 +1,67 @@
+import os
+import copy
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation as R
+from bvhTools.bvhIO import readBvh, writeBvh
+from bvhTools.bvhDataTypes import BVHData, MotionData
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testBvhFiles")
+POSES = [
+    ("test2", {"LeftLeg": [1.31714436e-05, 90, -9.00000553e+01]}),
+    ("test2", {"LeftUpLeg": [0, 0, 20], "LeftLeg": [10, 0, 0], "RightArm": [0, 30, -45]}),
+    ("test3", {"thigh.L": [0, 0, 20], "shin.L": [10, 0, 0], "upper_arm.R": [0, 30, -45]}),
+]
+
+def readSampledBvh(fileName, step=40):
+    # Frames spread over the whole clip, as lists, so the per-frame reference can edit them in place
+    bvhData = readBvh(os.path.join(TEST_FILES_DIR, fileName + ".bvh"))
+    frames = [list(frame) for frame in bvhData.motion.frames[::step]]
+    return BVHData(bvhData.skeleton, MotionData(len(frames), bvhData.motion.frameTime, frames), bvhData.header)
+
+def applyOffsetToChildrenReference(joint, rNew):
+    for child in joint.children:
+        length = np.linalg.norm(child.offset)
+        child.offset = rNew.apply(np.array([0, 1, 0]) * length)
+        applyOffsetToChildrenReference(child, rNew)
+
+def applyRotationReference(bvhData, joint, oldPose, newPose, rNew):
+    # One scipy rotation per frame and joint, as the routine that setRestPose replaced
+    for frame in bvhData.motion.frames:
+        rotationChannels = [0, 1, 2] if("rotation" in joint.channels[0] or "rotation" in joint.channels[1] or "rotation" in joint.channels[2]) else [3, 4, 5]
+        channelIndexes = [bvhData.skeleton.getJointIndex(joint.name) + channel for channel in rotationChannels]
+        oldRotation = R.from_euler(joint.getRotationChannelsOrder(), [frame[channelIndex] for channelIndex in channelIndexes], degrees=True)
+        newRotation = (rNew * oldPose[joint.name].inv() * oldRotation).as_euler(joint.getRotationChannelsOrder(), degrees=True)
+        for channelIndex, value in zip(channelIndexes, newRotation):
+            frame[channelIndex] = value
+    for child in joint.children:
+        if(not "_EndSite" in child.name):
+            applyRotationReference(bvhData, child, oldPose, newPose, newPose[child.name])
+
+def setRestPoseReference(bvhData, poseDict):
+    bvhData.skeleton = copy.deepcopy(bvhData.skeleton)
+    oldPose = bvhData.getRestPose()
+    newPose = {jointName: R.from_euler('XYZ', pose, degrees=True) for jointName, pose in poseDict.items()}
+    for joint in bvhData.skeleton.joints.values():
+        if(joint.name in poseDict.keys()):
+            rNew = newPose[joint.name]
+            applyOffsetToChildrenReference(joint, rNew)
+            bvhData.skeleton.resetLayout()
+            newPose = bvhData.getRestPose()
+            applyRotationReference(bvhData, joint, oldPose, newPose, rNew)
+    bvhData.rewriteHeaderOffsets()
+
+@pytest.mark.parametrize("fileName, poseDict", POSES)
+@pytest.mark.parametrize("dtype", [None, np.float64])
+def test_setRestPoseMatchesPerFrameReference(tmp_path, fileName, poseDict, dtype):
+    expectedBvh = readSampledBvh(fileName)
+    setRestPoseReference(expectedBvh, poseDict)
+    bvhData = readSampledBvh(fileName)
+    if(dtype is not None):
+        bvhData.motion = MotionData(bvhData.motion.numFrames, bvhData.motion.frameTime, bvhData.motion.frames, dtype)
+    bvhData.setRestPose(poseDict)
+
+    assert np.allclose(bvhData.motion.getFramesArray(), np.array(expectedBvh.motion.frames), rtol=0, atol=1e-9)
+    writeBvh(expectedBvh, tmp_path / "expected.bvh")
+    writeBvh(bvhData, tmp_path / "result.bvh")
+    assert (tmp_path / "result.bvh").read_bytes() == (tmp_path / "expected.bvh").read_bytes()
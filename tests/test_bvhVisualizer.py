@@ -0,0 +1,43 @@
+import os
+import sys
+import subprocess
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from bvhTools.bvhIO import readBvh
+from bvhTools.bvhRenderer import getPlaybackPositions, getBoneSegments, updateSkeletonArtists
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testBvhFiles")
+
+def test_blittedFramesAreProjected():
+    # Only draw_artist runs between two blitted frames, so the projected (2D) data has to be updated by the frame update itself
+    bvhData = readBvh(os.path.join(TEST_FILES_DIR, "test2.bvh"), dtype=np.float64)
+    positions = getPlaybackPositions(bvhData, frames=[0, 100])
+    parents = bvhData.skeleton.getLayout().parents
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection='3d')
+    scatter = ax.scatter(positions[0, :, 0], positions[0, :, 1], positions[0, :, 2])
+    bones = Line3DCollection(getBoneSegments(positions[0], parents))
+    ax.add_collection3d(bones)
+    fig.canvas.draw()
+
+    projectedFrames = []
+    for framePositions in positions:
+        updateSkeletonArtists(scatter, bones, framePositions, parents)
+        ax.draw_artist(scatter)
+        ax.draw_artist(bones)
+        projectedFrames.append((np.array(bones.get_segments()), np.array(scatter.get_offsets())))
+    (firstSegments, firstOffsets), (secondSegments, secondOffsets) = projectedFrames
+    assert firstSegments.shape == secondSegments.shape == (np.count_nonzero(parents >= 0), 2, 2)
+    assert not np.allclose(firstSegments, secondSegments)
+    assert not np.allclose(firstOffsets, secondOffsets)
+
+def test_rendererDoesNotImportPyplot():
+    # Render nodes may point MPLBACKEND to a GUI backend, which pyplot would try to load
+    environment = dict(os.environ, MPLBACKEND="QtAgg", PYTHONPATH=os.pathsep.join(sys.path))
+    code = "import sys, bvhTools.bvhRenderer; sys.exit('matplotlib.pyplot' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code], env=environment).returncode == 0